@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmark of SMD against a local fake MangaDex.
+
+Runs "update -i" for a tracked list of fake manga and reports the pages/s,
+bytes/s, time spent checking and downloading and the peak RSS. Results can be
+saved as JSON and compared with the results of another commit:
+
+    python benchmarks/bench_pipeline.py --output before.json
+    python benchmarks/bench_pipeline.py --compare before.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_mangadex import FakeMangadex  # noqa: E402
+
+from simple_manga_downloader import SMD, modules, utils  # noqa: E402
+from simple_manga_downloader.config_parser import Config  # noqa: E402
+from simple_manga_downloader.modules.mangadex_org import Mangadex  # noqa: E402
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--manga", type=int, default=10, help="Tracked manga")
+    parser.add_argument("--chapters", type=int, default=5, help="Chapters per manga")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per chapter")
+    parser.add_argument(
+        "--image-size", type=int, default=200 * 1024, help="Image size in bytes"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=int,
+        default=None,
+        help="Bytes per second per connection, unlimited by default",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        nargs=2,
+        metavar=("RATE", "BURST"),
+        default=None,
+        help="Overrides the rate limit of the fake server host",
+    )
+    parser.add_argument("--covers", action="store_true", help="Also get covers")
+    parser.add_argument(
+        "--batch", action="store_true", help="Prefetch the manga info in batches"
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--compare", help="Compare with saved JSON results")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Show the SMD output"
+    )
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    fake = FakeMangadex(
+        manga_count=args.manga,
+        chapters=args.chapters,
+        pages=args.pages,
+        image_size=args.image_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+    ).start()
+    Mangadex.base_link = fake.url
+    Mangadex.uploads_link = fake.url
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = Path(tmp) / "Manga"
+        config_path = Path(tmp) / "SMD_conf.json"
+        config = {
+            "manga_directory": str(library),
+            "covers": args.covers,
+            "tracking": {
+                f"Benchmark {manga_id}": f"https://mangadex.org/title/{manga_id}"
+                for manga_id in fake.manga_ids()
+            },
+        }
+        if args.rate_limit:
+            rate, burst = args.rate_limit
+            config["rate_limits"] = {"127.0.0.1": [rate, int(burst)]}
+        config_path.write_text(json.dumps(config))
+
+        SMD.CONFIG = Config(str(config_path))
+        SMD.ARGS = argparse.Namespace(
+            subparser_name="update",
+            custom_down_dire=None,
+            check_only=False,
+            ignore_input=True,
+            pipeline=False,
+            batch=args.batch,
+            data_saver=None,
+            langauge_code=None,
+            metrics_file=None,
+        )
+        utils.REPLACEMENT_RULES = SMD.CONFIG.replacement_rules
+        utils.RATE_LIMITS = SMD.CONFIG.rate_limits
+        utils.RETRY_POLICY = utils.RetryPolicy(
+            SMD.CONFIG.page_retries, budget=SMD.CONFIG.retry_budget
+        )
+
+        # Times the download phase separately from the checking
+        timings = {}
+        downloader = SMD.downloader
+
+        def timed_downloader(manga_objects):
+            timings["download_start"] = time.perf_counter()
+            downloader(manga_objects)
+            timings["download_end"] = time.perf_counter()
+
+        SMD.downloader = timed_downloader
+        output = sys.stdout if args.verbose else open(os.devnull, "w")
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                SMD.main_pipeline(list(SMD.CONFIG.tracked_manga.values()))
+        finally:
+            SMD.downloader = downloader
+            modules.BaseManga.check_only = False
+        end = time.perf_counter()
+
+        files = [p for p in library.rglob("*") if p.is_file()]
+        pages = len([p for p in files if p.parent.name.startswith("Chapter")])
+        size = sum(p.stat().st_size for p in files)
+
+    fake.stop()
+    download_start = timings.get("download_start", end)
+    download_end = timings.get("download_end", end)
+    download_time = download_end - download_start
+    return {
+        "commit": git_commit(),
+        "settings": {
+            "manga": args.manga,
+            "chapters": args.chapters,
+            "pages": args.pages,
+            "image_size": args.image_size,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "rate_limit": args.rate_limit,
+            "covers": args.covers,
+            "batch": args.batch,
+        },
+        "wall_time": end - start,
+        "check_time": download_start - start,
+        "download_time": download_time,
+        "requests": fake.requests,
+        "pages": pages,
+        "bytes": size,
+        "pages_per_second": pages / download_time if download_time else 0,
+        "bytes_per_second": size / download_time if download_time else 0,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+RESULT_LINES = (
+    ("wall_time", "Wall time", "{:.2f} s"),
+    ("check_time", "Check phase", "{:.2f} s"),
+    ("download_time", "Download phase", "{:.2f} s"),
+    ("requests", "Requests", "{}"),
+    ("pages", "Pages", "{}"),
+    ("pages_per_second", "Pages/s", "{:.1f}"),
+    ("bytes_per_second", "MiB/s", "{:.2f}"),
+    ("peak_rss_kib", "Peak RSS", "{} KiB"),
+)
+
+
+def print_results(results, baseline=None):
+    print(f"Commit: {results['commit']}")
+    if baseline:
+        print(f"Compared with: {baseline['commit']}")
+    for key, name, fmt in RESULT_LINES:
+        value = results[key]
+        if key == "bytes_per_second":
+            value /= 1024 * 1024
+        line = f"{name + ':':<16}{fmt.format(value)}"
+        if baseline and baseline.get(key):
+            change = (results[key] - baseline[key]) / baseline[key] * 100
+            line += f"  ({change:+.1f}%)"
+        print(line)
+
+
+def main():
+    args = parse_arguments()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(args)
+    if baseline and baseline["settings"] != results["settings"]:
+        print("Warning: the compared results used different settings")
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
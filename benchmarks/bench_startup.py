@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Startup time benchmark of the SMD command line.
+
+Runs quick SMD commands that don't download anything in fresh interpreters and
+reports the median wall time of every command and which of the heavy
+dependencies it imported. Results can be saved as JSON and compared with the
+results of another commit:
+
+    python benchmarks/bench_startup.py --output before.json
+    python benchmarks/bench_startup.py --compare before.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Dependencies that should only be imported when they are needed
+HEAVY_MODULES = (
+    "requests",
+    "urllib3",
+    "bs4",
+    "simple_manga_downloader.modules.mangadex_org",
+    "simple_manga_downloader.modules.mangakakalot_com",
+    "simple_manga_downloader.modules.manganato_com",
+    "simple_manga_downloader.modules.mangatown_com",
+)
+
+# Runs SMD with the given arguments, or only imports it without any, and
+# prints which of the heavy modules were imported
+RUNNER = """
+import sys
+from simple_manga_downloader.SMD import main
+if len(sys.argv) > 1:
+    sys.argv = ["SMD"] + sys.argv[1:]
+    try:
+        main()
+    except SystemExit:
+        pass
+heavy = [m for m in {heavy!r} if m in sys.modules]
+sys.stderr.write("HEAVY " + ",".join(heavy) + "\\n")
+"""
+
+# (name, SMD arguments), "{cfg}" and "{dir}" are replaced with temporary paths
+COMMANDS = (
+    ("import", []),
+    ("help", ["--help"]),
+    ("conf list", ["-c", "{cfg}", "conf", "--list-tracked"]),
+    ("conf print", ["-c", "{cfg}", "conf", "--print-conf"]),
+    ("verify", ["-c", "{cfg}", "verify", "-d", "{dir}", "-w", "1"]),
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "-n", "--runs", type=int, default=10, help="Runs of every command"
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--compare", help="Compare with saved JSON results")
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command(arguments):
+    """Runs the command once, returns the wall time and imported heavy modules"""
+    code = RUNNER.format(heavy=HEAVY_MODULES)
+    command = [sys.executable, "-c", code] + arguments
+    start = time.perf_counter()
+    result = subprocess.run(
+        command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    duration = time.perf_counter() - start
+    heavy = []
+    for line in result.stderr.splitlines():
+        if line.startswith("HEAVY "):
+            heavy = [m for m in line[len("HEAVY ") :].split(",") if m]
+    return duration, heavy
+
+
+def run(args):
+    results = {"commit": git_commit(), "runs": args.runs, "commands": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {"cfg": str(Path(tmp) / "SMD_conf.json"), "dir": tmp}
+        # The first run creates the config
+        run_command(["-c", paths["cfg"], "conf"])
+        for name, arguments in COMMANDS:
+            arguments = [a.format(**paths) for a in arguments]
+            times = []
+            for _ in range(args.runs):
+                duration, heavy = run_command(arguments)
+                times.append(duration)
+            results["commands"][name] = {
+                "median": statistics.median(times),
+                "min": min(times),
+                "imports": heavy,
+            }
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"Commit: {results['commit']}")
+    if baseline:
+        print(f"Compared with: {baseline['commit']}")
+    for name, command in results["commands"].items():
+        line = f"{name + ':':<14}{command['median'] * 1000:7.1f} ms"
+        old = baseline["commands"].get(name) if baseline else None
+        if old and old["median"]:
+            change = (command["median"] - old["median"]) / old["median"] * 100
+            line += f"  ({change:+.1f}%)"
+        print(line)
+        if command["imports"]:
+            print(f"{'':<14}imports {', '.join(command['imports'])}")
+
+
+def main():
+    args = parse_arguments()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(args)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""A local stand-in for the MangaDex API and image servers used by the benchmarks.
+
+Serves the endpoints used by the Mangadex module with configurable latency,
+bandwidth and image sizes. Every manga, chapter and page is generated from its
+ID so nothing has to be stored.
+"""
+import json
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+GROUP_ID = "00000000-0000-0000-0000-000000000001"
+# Chapter N was last updated N hours after this
+FIRST_UPDATE = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeMangadex:
+    """Settings and request counters of the fake server
+
+    manga_count = how many manga exist, IDs are "manga-0", "manga-1"...
+    chapters = chapters per manga
+    pages = pages per chapter
+    image_size = size of every image in bytes
+    latency = seconds every request waits before answering
+    bandwidth = bytes per second per connection, None for unlimited
+    """
+
+    def __init__(
+        self,
+        manga_count=10,
+        chapters=5,
+        pages=20,
+        image_size=200 * 1024,
+        latency=0.05,
+        bandwidth=None,
+    ):
+        self.manga_count = manga_count
+        self.chapters = chapters
+        self.pages = pages
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # A valid JPEG start and end so the type detection works
+        self.image = b"\xff\xd8\xff\xe0" + b"\x00" * (image_size - 6) + b"\xff\xd9"
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def manga_ids(self):
+        return [f"manga-{n}" for n in range(self.manga_count)]
+
+    def start(self):
+        """Starts the server on a free port in a background thread"""
+        handler = type("Handler", (FakeMangadexHandler,), {"fake": self})
+        self.server = ThreadingServer(("127.0.0.1", 0), handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def manga(self, manga_id):
+        return {
+            "id": manga_id,
+            "type": "manga",
+            "attributes": {"title": {"en": f"Benchmark {manga_id}"}},
+        }
+
+    def chapter(self, manga_id, n):
+        return {
+            "id": f"{manga_id}-ch-{n}",
+            "type": "chapter",
+            "attributes": {
+                "title": "",
+                "chapter": str(n),
+                "volume": "1",
+                "translatedLanguage": "en",
+                "updatedAt": (FIRST_UPDATE + timedelta(hours=n)).isoformat(),
+                "publishAt": (FIRST_UPDATE + timedelta(hours=n)).isoformat(),
+            },
+            "relationships": [
+                {
+                    "id": GROUP_ID,
+                    "type": "scanlation_group",
+                    "attributes": {"name": "Benchmark Scans"},
+                },
+                {"id": manga_id, "type": "manga"},
+            ],
+        }
+
+    def at_home(self, chapter_id):
+        files = [f"{n}.jpg" for n in range(self.pages)]
+        return {
+            "result": "ok",
+            "baseUrl": self.url,
+            "chapter": {"hash": chapter_id, "data": files, "dataSaver": files},
+        }
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMangadexHandler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.fake
+        with fake.lock:
+            fake.requests += 1
+        time.sleep(fake.latency)
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+
+        if parts[0] in ("data", "data-saver", "covers"):
+            self.send_image()
+        elif parts[0] == "manga" and len(parts) == 1:
+            found = [fake.manga(manga_id) for manga_id in query.get("ids[]", [])]
+            self.send_list(found, query)
+        elif parts[0] == "chapter" and len(parts) == 1:
+            chapters = [
+                fake.chapter(manga_id, n)
+                for manga_id in query.get("manga[]", [])
+                for n in range(1, fake.chapters + 1)
+            ]
+            self.send_list(filter_updated(chapters, query), query)
+        elif parts[0] == "manga" and len(parts) == 2:
+            self.send_json({"result": "ok", "data": fake.manga(parts[1])})
+        elif parts[0] == "manga" and len(parts) == 3 and parts[2] == "feed":
+            chapters = [fake.chapter(parts[1], n) for n in range(1, fake.chapters + 1)]
+            self.send_list(filter_updated(chapters, query), query)
+        elif parts[0] == "cover":
+            covers = [
+                {
+                    "type": "cover_art",
+                    "attributes": {"volume": "1", "fileName": "c.jpg"},
+                    "relationships": [{"id": manga_id, "type": "manga"}],
+                }
+                for manga_id in query.get("manga[]", [])
+            ]
+            self.send_list(covers, query)
+        elif parts[0] == "at-home" and len(parts) == 3:
+            self.send_json(fake.at_home(parts[2]))
+        else:
+            self.send_error(404)
+
+    def send_list(self, items, query):
+        limit = int(query.get("limit", ["10"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        self.send_json(
+            {
+                "result": "ok",
+                "data": items[offset : offset + limit],
+                "limit": limit,
+                "offset": offset,
+                "total": len(items),
+            }
+        )
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_image(self):
+        image = self.fake.image
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(image)))
+        self.end_headers()
+
+        bandwidth = self.fake.bandwidth
+        if bandwidth is None:
+            self.wfile.write(image)
+            return
+        # Sends the image in 10 chunks per second to emulate the bandwidth
+        chunk_size = max(1, bandwidth // 10)
+        for start in range(0, len(image), chunk_size):
+            self.wfile.write(image[start : start + chunk_size])
+            time.sleep(0.1)
+
+
+def filter_updated(chapters, query):
+    """Applies the updatedAtSince filter of the query"""
+    if "updatedAtSince" not in query:
+        return chapters
+    since = query["updatedAtSince"][0]
+    return [c for c in chapters if c["attributes"]["updatedAt"][:19] >= since]
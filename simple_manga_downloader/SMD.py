@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
-import imghdr
-import shutil
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 
-import requests
-
-from . import __version__, modules, utils
+from . import __version__, metrics, modules, stats, storage, utils
 from .arg_parser import parse_arguments
 from .config_parser import Config
 
+# Images are written in chunks of this size so they are never fully in memory
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# How many checked manga can wait for the download in pipeline mode
+PIPELINE_QUEUE_SIZE = 4
+# Max amount of image requests running at the same time for hedging
+HEDGE_WORKERS = 32
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
 
 def main():
     global ARGS
@@ -21,10 +29,21 @@ def main():
         print("\nLoading config failed")
         return 1
     utils.REPLACEMENT_RULES = CONFIG.replacement_rules
+    utils.RATE_LIMITS = CONFIG.rate_limits
+    utils.RETRY_POLICY = utils.RetryPolicy(
+        CONFIG.page_retries, budget=CONFIG.retry_budget
+    )
 
-    try:
-        mode = ARGS.subparser_name
+    mode = ARGS.subparser_name
+    if mode in ("down", "update"):
+        modules.add_response_hook(stats.STATS.record_response)
+        if CONFIG.cache:
+            from . import cache
+
+            size = CONFIG.cache_size * 1024 * 1024
+            modules.install_cache(cache.ResponseCache(CONFIG.cache_path, size))
 
+    try:
         if mode == "down":
             main_pipeline(ARGS.input)
         elif mode == "update":
@@ -33,13 +52,43 @@ def main():
             conf_mode()
         elif mode == "version":
             return version_mode()
+        elif mode == "dedupe":
+            dedupe_mode()
+        elif mode == "reindex":
+            reindex_mode()
+        elif mode == "verify":
+            verify_mode()
     except KeyboardInterrupt:
         print("\nKeyboard Interrupt detected, stopping!")
     finally:
+        if mode in ("down", "update"):
+            modules.flush_reports()
+            report_stats()
         exit_code = CONFIG.save_config()
     return exit_code
 
 
+def report_stats():
+    """Prints and saves the run statistics if asked to"""
+    if ARGS.stats:
+        stats.STATS.print_summary()
+    if ARGS.stats_file:
+        try:
+            stats.STATS.save(ARGS.stats_file)
+        except OSError as e:
+            print(f"\nFailed to save the statistics: {e}")
+    write_metrics()
+
+
+def write_metrics():
+    """Updates the metrics file if one is used"""
+    if ARGS.metrics_file:
+        try:
+            metrics.write_textfile(stats.STATS, ARGS.metrics_file)
+        except OSError as e:
+            print(f"\nFailed to write the metrics: {e}")
+
+
 def site_detect(link, tracked_allow=True):
     """Detects the site and creates a proper manga object"""
 
@@ -74,11 +123,7 @@ def get_cover(manga):
     Gets the cover for given manga
     Skips if cover already saved
     """
-    try:
-        files = {file.stem for file in manga.manga_dir.iterdir() if file.is_file()}
-    except FileNotFoundError:
-        files = set()
-
+    files = storage.LIBRARY_INDEX.covers(manga.series_title)
     to_download = {
         filename: url for filename, url in manga.covers.items() if filename not in files
     }
@@ -94,10 +139,11 @@ def get_cover(manga):
     # fmt: on
     successful = 0
     for filename, url in to_download.items():
-        no_ext = manga.manga_dir / filename
-        status = download_image(url, manga.session, no_ext)
+        page = storage.PageFile(manga.manga_dir / filename)
+        status = download_image(url, manga, page)
         if status is True:
             successful += 1
+            storage.LIBRARY_INDEX.add_cover(manga.series_title, filename)
         else:
             print(f'Error while getting "{filename}":')
             print(status)
@@ -118,6 +164,77 @@ def version_mode():
     return 0
 
 
+def dedupe_mode():
+    """Dedupe mode, replaces duplicate files in the library with hardlinks"""
+    if ARGS.custom_down_dire:
+        path = Path(ARGS.custom_down_dire).resolve()
+    else:
+        path = CONFIG.manga_directory
+    if not path.is_dir():
+        print(f'Directory doesn\'t exist: "{path}"')
+        return
+
+    print(f'Looking for duplicate files in "{path}"')
+    replaced, saved = storage.dedupe_library(path, ARGS.workers)
+    print(
+        f"Replaced {replaced} duplicate file(s), reclaimed {utils.format_size(saved)}"
+    )
+
+
+def reindex_mode():
+    """Reindex mode, rebuilds the library index from what is on the disk"""
+    if ARGS.custom_down_dire:
+        path = Path(ARGS.custom_down_dire).resolve()
+    else:
+        path = CONFIG.manga_directory
+    if not path.is_dir():
+        print(f'Directory doesn\'t exist: "{path}"')
+        return
+
+    print(f'Indexing "{path}"')
+    manga, chapters = storage.LibraryIndex(path).reindex()
+    print(f"Found {chapters} chapter(s) of {manga} manga")
+
+
+def verify_mode():
+    """Verify mode, looks for broken images in the downloaded chapters"""
+    from . import verify
+
+    if ARGS.custom_down_dire:
+        path = Path(ARGS.custom_down_dire).resolve()
+    else:
+        path = CONFIG.manga_directory
+    if not path.is_dir():
+        print(f'Directory doesn\'t exist: "{path}"')
+        return
+    if ARGS.decode and verify.Image is None:
+        print("Decoding the images needs Pillow, install it with:")
+        print("pip install Pillow")
+        return
+
+    print(f'Verifying "{path}"')
+    index = storage.LibraryIndex(path)
+    checked = 0
+    broken = 0
+    for chapter_path, problems in verify.verify_library(
+        path, ARGS.workers, ARGS.decode
+    ):
+        checked += 1
+        if not problems:
+            continue
+        broken += 1
+        print(f"\n{Path(chapter_path).relative_to(path)}:")
+        for problem in problems:
+            print(f"    {problem}")
+        if ARGS.quarantine:
+            target = verify.quarantine(index, chapter_path)
+            print(f'    Moved to "{target}"')
+    index.close()
+    print(f"\nChecked {checked} chapter(s), {broken} broken")
+    if broken and not ARGS.quarantine:
+        print("Use --quarantine to move them away so they are downloaded again")
+
+
 @utils.request_exception_handler
 def check_for_update():
     """Checks for new versions using the PyPI API"""
@@ -125,6 +242,7 @@ def check_for_update():
         from pkg_resources import parse_version
     except ModuleNotFoundError:
         return "Can't check version because pkg_resources not installed"
+    import requests
 
     r = requests.get("https://pypi.org/pypi/simple-manga-downloader/json")
     r.raise_for_status()
@@ -170,12 +288,24 @@ def conf_mode():
             rename_old_files(renamed[0], renamed[1])
     if ARGS.toggle_covers:
         CONFIG.toogle_covers()
+    if ARGS.toggle_cbz:
+        CONFIG.toggle_cbz()
+    if ARGS.toggle_dedupe:
+        CONFIG.toggle_dedupe()
+    if ARGS.toggle_cache:
+        CONFIG.toggle_cache()
+    if ARGS.clear_cache:
+        CONFIG.clear_cache()
     if ARGS.change_lang:
         CONFIG.change_lang(ARGS.change_lang)
     if ARGS.list_lang:
         CONFIG.list_lang()
     if ARGS.timeout is not None:
         CONFIG.change_timeout(ARGS.timeout)
+    if ARGS.check_workers is not None:
+        CONFIG.change_check_workers(ARGS.check_workers)
+    if ARGS.retries is not None:
+        CONFIG.change_retries(ARGS.retries)
     if ARGS.data_saver:
         CONFIG.toogle_data_saver()
     if ARGS.replacement_reset:
@@ -216,6 +346,9 @@ def main_pipeline(links):
     else:
         path = CONFIG.manga_directory
     modules.set_download_directory(path)
+    storage.LIBRARY_INDEX = storage.LibraryIndex(path)
+    if CONFIG.dedupe:
+        storage.PAGE_STORE = storage.PageStore(path / storage.STORE_NAME)
 
     if ARGS.check_only or ARGS.ignore_input:
         modules.toggle_check_only()
@@ -226,16 +359,30 @@ def main_pipeline(links):
         modules.set_data_saver(True)
     else:
         modules.set_data_saver(False)
+    modules.set_download_tuning(CONFIG.hedged_modules, CONFIG.min_throughput)
 
-    ready = []
-    total_num_ch = 0
-    found_titles = {}
+    manga_objects = []
     for link in links:
         manga = site_detect(link)
-        if not manga:
-            continue
+        if manga:
+            if ARGS.subparser_name == "update":
+                manga.feed_mark = get_feed_mark(manga)
+            manga_objects.append(manga)
+
+    if ARGS.subparser_name == "update" and ARGS.batch:
+        with stats.STATS.phase("prefetch"):
+            modules.prefetch_mangadex(manga_objects)
+
+    if ARGS.pipeline:
+        if ARGS.ignore_input:
+            pipeline_download(manga_objects)
+            return
+        print("\n--pipeline only works together with -i/--ignore-input, ignoring it")
 
-        status = handle_manga(manga)
+    ready = []
+    total_num_ch = 0
+    found_titles = {}
+    for manga, status in zip(manga_objects, check_all(manga_objects)):
         if status:
             ready.append(manga)
             total_num_ch += len(manga)
@@ -280,12 +427,119 @@ def main_pipeline(links):
         print("Aborting!")
 
 
+def get_feed_mark(manga):
+    """
+    Returns the saved feed mark of the manga if it can be used
+    The whole feed is used again if the language or download directory
+    changed or if the last full sync is too old
+    """
+    mark = CONFIG.feed_marks.get(manga.manga_link)
+    if not mark or not CONFIG.full_resync_days:
+        return None
+    if mark.get("lang") != modules.get_mangadex_language():
+        return None
+    if mark.get("directory") != str(manga.directory):
+        return None
+    if time.time() - mark.get("full_sync", 0) > CONFIG.full_resync_days * 86400:
+        return None
+    return mark.get("mark")
+
+
+def commit_feed_mark(manga):
+    """
+    Saves the new feed mark of the manga, should only be called when all of
+    the new chapters are downloaded
+    """
+    if ARGS.subparser_name != "update" or manga.new_feed_mark is None:
+        return
+    if manga.feed_mark is None:
+        full_sync = time.time()
+    else:
+        full_sync = CONFIG.feed_marks[manga.manga_link]["full_sync"]
+    CONFIG.feed_marks[manga.manga_link] = {
+        "mark": manga.new_feed_mark,
+        "lang": modules.get_mangadex_language(),
+        "directory": str(manga.directory),
+        "full_sync": full_sync,
+    }
+
+
+def check_all(manga_objects):
+    """
+    Runs handle_manga for all of the manga using the check worker pool
+    The output of every manga is printed in one piece once it's checked, the
+    questions the modules ask are answered on the main thread one at a time
+    Returns a list of the statuses in the same order as the manga
+    """
+    executor = ThreadPoolExecutor(max_workers=CONFIG.check_workers)
+    futures = []
+    try:
+        with utils.main_thread_prompts() as prompts:
+            for manga in manga_objects:
+                futures.append(executor.submit(check_buffered, manga))
+            prompts.serve(futures)
+        return [future.result() for future in futures]
+    except KeyboardInterrupt:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+
+def pipeline_download(manga_objects):
+    """Downloads the chapters of every manga as soon as it's checked"""
+    ready = checked_manga(manga_objects)
+    try:
+        downloader(ready)
+    finally:
+        ready.close()
+
+
+def checked_manga(manga_objects):
+    """
+    A generator that yields the manga with chapters ready to download as soon
+    as they are checked
+    Only a limited amount of manga is checked ahead of the downloads, the rest
+    waits until the downloader catches up
+    """
+    to_check = iter(manga_objects)
+    max_pending = CONFIG.check_workers + PIPELINE_QUEUE_SIZE
+    executor = ThreadPoolExecutor(max_workers=CONFIG.check_workers)
+    pending = {}
+    try:
+        while True:
+            for manga in to_check:
+                pending[executor.submit(check_buffered, manga)] = manga
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                manga = pending.pop(future)
+                if future.result():
+                    yield manga
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def check_buffered(manga):
+    """Calls handle_manga with the output buffered"""
+    with utils.buffered_output():
+        return handle_manga(manga)
+
+
 def handle_manga(manga):
     """
     Handles all stuff related to a single manga
     returns True if everything fine
     """
-    main_status = manga.get_main()
+    with stats.STATS.phase("get_main", manga.series_title or manga.manga_link):
+        main_status = manga.get_main()
     if main_status is not True:
         # fmt: off
         print(
@@ -300,20 +554,26 @@ def handle_manga(manga):
     line_break = make_line(message)
     print(f"\n{line_break}\n{message}\n{line_break}\n")
 
+    title = manga.series_title
     if CONFIG.covers and manga.covers:
-        get_cover(manga)
+        with stats.STATS.phase("covers", title):
+            get_cover(manga)
 
-    manga.get_chapters()
+    with stats.STATS.phase("get_chapters", title):
+        manga.get_chapters()
     filter_wanted(manga)
 
     if not manga.chapters:
         print("Found 0 matching chapters")
+        commit_feed_mark(manga)
         return False
 
     message2 = f"Getting info about {len(manga)} matching chapter(s)"
     line_break2 = make_line(message2)
     print(f"{message2}\n{line_break2}")
-    return chapter_info_get(manga)
+    status = chapter_info_get(manga)
+    stats.STATS.record_chapters(type(manga).__name__, "found", len(manga))
+    return status
 
 
 def filter_wanted(manga):
@@ -365,29 +625,25 @@ def filter_selection(chapter_list):
 
 
 def filter_downloaded(manga_dir, wanted):
-    """Filters the "wanted" based on what is already downloaded"""
-    if not manga_dir.is_dir():
-        filtered = list(wanted)
-    else:
-        filtered = []
-        directory_contents = {
-            item.name for item in manga_dir.iterdir() if item.is_dir()
-        }
-        for n in wanted:
-            chapter_name = f"Chapter {n}"
-            if chapter_name not in directory_contents:
-                filtered.append(n)
-    return filtered
+    """
+    Filters the "wanted" based on what is already downloaded
+    Uses the library index, unfinished chapters aren't in it
+    """
+    downloaded = storage.LIBRARY_INDEX.chapters(manga_dir.name)
+    return [n for n in wanted if f"Chapter {n}" not in downloaded]
 
 
 def chapter_info_get(manga):
     """Calls the get_info() of the manga objects"""
     for ch in list(manga.chapters):
         print(f"    Chapter {ch}")
-        status = manga.get_info(ch)
+        with stats.STATS.phase("get_info", manga.series_title):
+            status = manga.get_info(ch)
         if status is not True:
             print(f"{status}")
             del manga.chapters[ch]
+            # The skipped chapter has to be in the feed again next time
+            manga.new_feed_mark = None
             print()
     return bool(manga.chapters)
 
@@ -402,7 +658,9 @@ def downloader(manga_objects):
 
     for manga in manga_objects:
         manga.manga_dir.mkdir(parents=True, exist_ok=True)
+        storage.sweep_staging(manga.manga_dir)
 
+        all_downloaded = True
         for ch in manga.chapters:
             status = get_chapter(manga, ch)
             page_total += status[0]
@@ -415,36 +673,205 @@ def downloader(manga_objects):
             if status[1]:
                 fail_list = failed.setdefault(manga.series_title, [])
                 fail_list.append(to_append)
+                all_downloaded = False
+                stats.STATS.record_chapters(type(manga).__name__, "failed")
             else:
                 succ_list = success.setdefault(manga.series_title, [])
                 succ_list.append(to_append)
+                stats.STATS.record_chapters(type(manga).__name__, "downloaded")
+            write_metrics()
+        if all_downloaded:
+            commit_feed_mark(manga)
 
     total_time = time.time() - start_time
     download_summary(page_total, failed, success, total_time)
 
 
-@utils.limiter(0.5)
+def download_page(manga, data, n, page):
+    """
+    Downloads page n of the chapter data, the module gets to pick the link
+    and can move failed pages to another server
+    page = save target from the storage module (PageFile or ArchivePage)
+    """
+    link = manga.get_page_link(data, n)
+    while True:
+        result = download_image(link, manga, page)
+        if result is True:
+            manga.page_downloaded(data, n, link, page.transfer_time)
+            return True
+        new_link = manga.page_failed(data, n, link, result)
+        if not new_link or new_link == link:
+            return result
+        link = new_link
+
+
 @utils.request_exception_handler
-def download_image(link, session, no_ext):
+@utils.retry
+def download_image(link, manga, page):
     """
-    Download function, gets the image from the link, limited by wrapper
-    no_ext = save target Path object with no file extension
+    Download function, gets the image from the link
+    Limited by the rate limiter of the link host, failed downloads are
+    retried based on the retry policy
+    manga = the manga object the image belongs to
+    page = save target from the storage module (PageFile or ArchivePage)
     """
-    content = session.get(link, stream=True, timeout=CONFIG.download_timeout)
+    with stats.STATS.phase("download_image", manga.series_title):
+        return stream_image(link, manga, page)
 
-    content.raise_for_status()
-    file_type = imghdr.what("", h=content.content)
-    if not file_type:
-        header = content.headers["Content-Type"]
-        file_type = header.split("/")[1].split(";")[0]
 
-    with open(f"{no_ext}.{file_type}", "wb") as f:
-        for chunk in content.iter_content(None):
-            f.write(chunk)
+def stream_image(link, manga, page):
+    """
+    Streams the image into the page, used by download_image
+    Sets page.transfer_time to the time from sending the request to the end
+    of the body, without the rate limiter wait
+    """
+    manga.get_limiter(link).acquire()
+    start = time.monotonic()
+    # Continues a partial download if there is one
+    offset = page.offset
+    if offset >= 16:
+        headers = {"Range": f"bytes={offset}-"}
+    else:
+        offset = 0
+        headers = None
+
+    content = open_image(link, manga, headers)
+    if content.status_code == 416:
+        # The partial file doesn't match the image any more
+        content.close()
+        page.discard()
+        offset = 0
+        content = open_image(link, manga)
+    content.raise_for_status()
 
+    resumed = offset and content.status_code == 206
+    if resumed and not content.headers.get("Content-Range", "").startswith(
+        f"bytes {offset}-"
+    ):
+        content.close()
+        page.discard()
+        return "Server returned the wrong part of the image"
+
+    with content:
+        if manga.min_throughput:
+            # Small chunks so a slow download is noticed quickly
+            chunk_size = int(min(DOWNLOAD_CHUNK_SIZE, manga.min_throughput / 4))
+            chunks = watch_throughput(
+                content.iter_content(max(1024, chunk_size)),
+                manga.min_throughput,
+                content.request,
+            )
+        else:
+            chunks = content.iter_content(DOWNLOAD_CHUNK_SIZE)
+        # The first bytes are enough to tell the image type
+        if resumed:
+            head = page.read_head(16)
+        else:
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= 16:
+                    break
+
+        file_type = utils.image_type(head)
+        if not file_type:
+            header = content.headers.get("Content-Type", "")
+            if "/" not in header:
+                return "Unknown image type"
+            file_type = header.split("/")[1].split(";")[0]
+
+        size = 0
+        with page.open(append=resumed) as f:
+            if not resumed:
+                f.write(head)
+                size += len(head)
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+
+    page.transfer_time = time.monotonic() - start
+    page.commit(file_type)
+    stats.STATS.record_page(type(manga).__name__, size)
     return True
 
 
+def open_image(link, manga, headers=None):
+    """
+    Makes the streamed GET request of the image, if the module uses hedging
+    a second request is made when the first one is slower than the p95
+    response time of the host
+    """
+    kwargs = {"stream": True, "timeout": CONFIG.download_timeout, "headers": headers}
+    if not manga.hedge_requests:
+        return manga.session.get(link, **kwargs)
+    delay = utils.latency_p95(link)
+    if delay is None:
+        r = manga.session.get(link, **kwargs)
+    else:
+        r = hedged_get(link, manga, delay, kwargs)
+    utils.record_latency(link, r.elapsed.total_seconds())
+    return r
+
+
+def hedged_get(link, manga, delay, kwargs):
+    """
+    Starts a second request if the first one doesn't answer in delay seconds
+    Returns the response that came first, the other one is closed
+    """
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+    executor = _hedge_executor
+
+    first = executor.submit(manga.session.get, link, **kwargs)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    manga.get_limiter(link).acquire()
+    second = executor.submit(manga.session.get, link, **kwargs)
+    futures = [first, second]
+    pending = set(futures)
+    errors = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = None
+        for future in futures:
+            if future in done and future.exception() is None:
+                winner = future
+                break
+        if winner is None:
+            errors.extend(future.exception() for future in done)
+            continue
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(close_response)
+        stats.STATS.record_hedge(link, winner is second)
+        return winner.result()
+    stats.STATS.record_hedge(link, False)
+    raise errors[0]
+
+
+def close_response(future):
+    """
+    Closes the response of the request that lost the hedge
+    The response is marked with hedge_loser so it's not seen as a failure
+    """
+    if not future.cancelled() and future.exception() is None:
+        response = future.result()
+        response.hedge_loser = True
+        response.close()
+
+
+def watch_throughput(chunks, min_throughput, request):
+    """Passes on the chunks, raises DownloadStalled if they come too slowly"""
+    detector = utils.StallDetector(min_throughput, request)
+    for chunk in chunks:
+        detector.update(len(chunk))
+        yield chunk
+
+
 def download_summary(count, failed, success, total_time):
     """Prints the summary of the download"""
     if count:
@@ -478,6 +905,9 @@ def get_chapter(manga, num):
     Downloads the pages for the given chapter
     Returns number of downloaded pages and failed bool
     num = number of the chapter to get
+
+    Unfinished chapters are kept so a failed or interrupted chapter only
+    needs the missing pages on the next run
     """
 
     count = 0
@@ -490,29 +920,60 @@ def get_chapter(manga, num):
         "\n------------------------"
     )
     # fmt: on
-    ch_dir = manga.manga_dir / chapter_name
-    ch_dir.mkdir()
-
+    pages = list(page_name_gen(title, manga.chapters[num], chapter_name))
+    page_names = [page_name for page_name, _ in pages]
+    if CONFIG.cbz:
+        path = manga.manga_dir / f"{chapter_name}.cbz"
+        chapter = storage.ArchiveChapter(path, page_names)
+    else:
+        chapter = storage.DirectoryChapter(manga.manga_dir / chapter_name, page_names)
+    if chapter.done:
+        print(f"Resuming, {len(chapter.done)} page(s) already downloaded")
+
+    executor = ThreadPoolExecutor(max_workers=manga.page_workers)
+    data = manga.chapters[num]
+    futures = {
+        executor.submit(download_page, manga, data, n, chapter.page(page_name)): n
+        for n, (page_name, _) in enumerate(pages)
+        if n not in chapter.done
+    }
     try:
-        name_gen = page_name_gen(title, manga.chapters[num], chapter_name)
-        for page_name, link in name_gen:
-            no_ext = ch_dir / page_name
-            image = download_image(link, manga.session, no_ext)
+        for future in as_completed(futures):
+            image = future.result()
             if image is not True:
                 print("Failed to get image, skipping to next chapter")
                 print(image)
                 failed = True
-                count = 0
-                shutil.rmtree(ch_dir)
+                cancel_pages(executor, futures)
                 break
             else:
+                print(f"    Page {futures[future]}")
+                chapter.page_done(futures[future])
                 count += 1
     except KeyboardInterrupt:
-        shutil.rmtree(ch_dir)
+        cancel_pages(executor, futures)
         raise KeyboardInterrupt
+    finally:
+        executor.shutdown()
+        # Pages that finished while the chapter was being stopped
+        for future, n in futures.items():
+            if n not in chapter.done and future.done() and not future.cancelled():
+                if future.result() is True:
+                    chapter.page_done(n)
+                    count += 1
+        chapter.close()
+        if chapter.complete:
+            storage.LIBRARY_INDEX.add_chapter(title, chapter.path)
     return (count, failed)
 
 
+def cancel_pages(executor, futures):
+    """Cancels the pending page downloads and waits for the running ones"""
+    for future in futures:
+        future.cancel()
+    executor.shutdown()
+
+
 def page_name_gen(manga_title, data, chapter_name):
     """A generator that yields a tuple with the page name and link"""
     for n, link in enumerate(data["pages"]):
@@ -525,7 +986,6 @@ def page_name_gen(manga_title, data, chapter_name):
         else:
             image_name = " ".join([base_name, page_string])
 
-        print(f"    {page_string}")
         yield (image_name, link)
 
 
@@ -552,10 +1012,16 @@ def rename_old_files(old_title, new_title):
             for page in chapter_dir.iterdir():
                 new_file_name = page.name.replace(old_title, new_title, 1)
                 page.rename(page.parent / new_file_name)
+        elif chapter_dir.name.endswith((".cbz", ".cbz.part")):
+            storage.rename_archive_pages(chapter_dir, old_title, new_title)
         else:
             new_file_name = chapter_dir.name.replace(old_title, new_title, 1)
             chapter_dir.rename(chapter_dir.parent / new_file_name)
     manga_dir.rename(manga_dir.parent / new_title)
+    index = storage.LibraryIndex(CONFIG.manga_directory)
+    index.forget_manga(old_title)
+    index.forget_manga(new_title)
+    index.close()
     print("Files have been renamed")
     return True
 
@@ -55,6 +55,21 @@ def parse_arguments():
         help="Downloader will be in update mode",
         description="Download new chapters from tracked list",
     )
+    parser_dedupe = subparsers.add_parser(
+        "dedupe",
+        help="Downloader will be in dedupe mode",
+        description="Replaces duplicate files in the download directory with hardlinks",
+    )
+    parser_reindex = subparsers.add_parser(
+        "reindex",
+        help="Downloader will be in reindex mode",
+        description="Rebuilds the index of the downloaded chapters from the files in the download directory",
+    )
+    parser_verify = subparsers.add_parser(
+        "verify",
+        help="Downloader will be in verify mode",
+        description="Looks for truncated or corrupt images in the downloaded chapters",
+    )
     parser_version = subparsers.add_parser(
         "version",
         help="Downloader will be in version mode",
@@ -102,6 +117,30 @@ def parse_arguments():
         metavar=r"{yes(y),no(n)}",
         dest="data_saver",
     )
+    parser_down.add_argument(
+        "--pipeline",
+        help="Used with -i, starts downloading the chapters of a manga as soon as it's checked instead of waiting for all of the manga",
+        action="store_true",
+        dest="pipeline",
+    )
+    parser_down.add_argument(
+        "--stats",
+        help="Print timing and request statistics of every phase at the end",
+        action="store_true",
+        dest="stats",
+    )
+    parser_down.add_argument(
+        "--stats-file",
+        help="Save the timing and request statistics as JSON",
+        metavar="PATH/TO/FILE",
+        dest="stats_file",
+    )
+    parser_down.add_argument(
+        "--metrics-file",
+        help="Write Prometheus text format metrics to the file, updated after every chapter",
+        metavar="PATH/TO/FILE",
+        dest="metrics_file",
+    )
     parser_down.add_argument(
         "--language",
         help="Overwrite the Mangadex language setting",
@@ -229,6 +268,30 @@ def parse_arguments():
         action="store_true",
         dest="toggle_covers",
     )
+    parser_conf.add_argument(
+        "--cbz",
+        help="Toggles saving chapters as .cbz archives instead of directories",
+        action="store_true",
+        dest="toggle_cbz",
+    )
+    parser_conf.add_argument(
+        "--dedupe",
+        help="Toggles replacing downloaded pages that are already in the library with hardlinks",
+        action="store_true",
+        dest="toggle_dedupe",
+    )
+    parser_conf.add_argument(
+        "--cache",
+        help="Toggles caching the manga info and chapter lists for a while",
+        action="store_true",
+        dest="toggle_cache",
+    )
+    parser_conf.add_argument(
+        "--clear-cache",
+        help="Removes everything from the response cache",
+        action="store_true",
+        dest="clear_cache",
+    )
     parser_conf.add_argument(
         "--change-lang",
         help="Changes the mangadex language code",
@@ -246,6 +309,20 @@ def parse_arguments():
         type=int,
         dest="timeout",
     )
+    parser_conf.add_argument(
+        "--retries",
+        help="Change how many times a page download is attempted before the chapter fails",
+        metavar="NUMBER",
+        type=int,
+        dest="retries",
+    )
+    parser_conf.add_argument(
+        "--check-workers",
+        help="Change how many manga are checked for new chapters at the same time",
+        metavar="NUMBER",
+        type=int,
+        dest="check_workers",
+    )
     parser_conf.add_argument(
         "--rule-reset",
         help="Resets the replacement rules to the default",
@@ -305,6 +382,36 @@ def parse_arguments():
         default=None,
         help="Custom path for manga download",
     )
+    parser_update.add_argument(
+        "--pipeline",
+        help="Used with -i, starts downloading the chapters of a manga as soon as it's checked instead of waiting for all of the manga",
+        action="store_true",
+        dest="pipeline",
+    )
+    parser_update.add_argument(
+        "--batch",
+        help="Get the info of the Mangadex manga together in a few big requests instead of a few requests for every manga",
+        action="store_true",
+        dest="batch",
+    )
+    parser_update.add_argument(
+        "--stats",
+        help="Print timing and request statistics of every phase at the end",
+        action="store_true",
+        dest="stats",
+    )
+    parser_update.add_argument(
+        "--stats-file",
+        help="Save the timing and request statistics as JSON",
+        metavar="PATH/TO/FILE",
+        dest="stats_file",
+    )
+    parser_update.add_argument(
+        "--metrics-file",
+        help="Write Prometheus text format metrics to the file, updated after every chapter",
+        metavar="PATH/TO/FILE",
+        dest="metrics_file",
+    )
     parser_update.add_argument(
         "--language",
         help="Overwrite the Mangadex language setting",
@@ -318,6 +425,62 @@ def parse_arguments():
         dest="data_saver",
     )
 
+    # Dedupe options
+    parser_dedupe.add_argument(
+        "-d",
+        "--directory",
+        dest="custom_down_dire",
+        metavar="PATH/TO/DIRECTORY",
+        default=None,
+        help="Custom path to deduplicate",
+    )
+    parser_dedupe.add_argument(
+        "-w",
+        "--workers",
+        help="How many files are hashed at the same time",
+        metavar="NUMBER",
+        type=int,
+        default=None,
+    )
+
+    # Reindex options
+    parser_reindex.add_argument(
+        "-d",
+        "--directory",
+        dest="custom_down_dire",
+        metavar="PATH/TO/DIRECTORY",
+        default=None,
+        help="Custom path to index",
+    )
+
+    # Verify options
+    parser_verify.add_argument(
+        "-d",
+        "--directory",
+        dest="custom_down_dire",
+        metavar="PATH/TO/DIRECTORY",
+        default=None,
+        help="Custom path to verify",
+    )
+    parser_verify.add_argument(
+        "-w",
+        "--workers",
+        help="How many processes check chapters at the same time",
+        metavar="NUMBER",
+        type=int,
+        default=None,
+    )
+    parser_verify.add_argument(
+        "--decode",
+        help="Also fully decode every image, slow and needs Pillow",
+        action="store_true",
+    )
+    parser_verify.add_argument(
+        "--quarantine",
+        help="Move broken chapters to .smd_quarantine in the download directory so they are downloaded again",
+        action="store_true",
+    )
+
     # Version options
     parser_version.add_argument(
         "-c",
@@ -0,0 +1,181 @@
+"""On-disk cache of the API and site responses used by the modules."""
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Responses bigger than this are never cached
+MAX_ENTRY_SIZE = 2 * 1024 * 1024
+# How much of the size cap is left free after evicting
+EVICT_TO = 0.9
+
+
+class ResponseCache:
+    """SQLite store of cached responses
+
+    path = Path object of the database file
+    max_size = size cap of all of the cached bodies in bytes, the least
+    recently used entries are evicted once it's reached
+    """
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, "
+            "expires REAL, last_used REAL, size INTEGER)"
+        )
+        self.db.commit()
+
+    def get(self, url):
+        """Returns (status, headers, body, expires) or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, headers, body, expires FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE responses SET last_used = ? WHERE url = ?", (time.time(), url)
+            )
+            self.db.commit()
+        status, headers, body, expires = row
+        return (status, json.loads(headers), body, expires)
+
+    def put(self, url, status, headers, body, ttl):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, status, json.dumps(headers), body, now + ttl, now, len(body)),
+            )
+            self.evict()
+            self.db.commit()
+
+    def refresh(self, url, ttl):
+        """Extends the expiry time of a revalidated entry"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE responses SET expires = ?, last_used = ? WHERE url = ?",
+                (now + ttl, now, url),
+            )
+            self.db.commit()
+
+    def evict(self):
+        """Removes the least recently used entries if the cache is too big"""
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self.max_size:
+            return
+        to_free = total - self.max_size * EVICT_TO
+        rows = self.db.execute("SELECT url, size FROM responses ORDER BY last_used")
+        to_remove = []
+        for url, size in rows:
+            if to_free <= 0:
+                break
+            to_remove.append((url,))
+            to_free -= size
+        self.db.executemany("DELETE FROM responses WHERE url = ?", to_remove)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def clear_cache(path):
+    """Removes the cache database, returns False if there was none"""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class CachingAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter that caches the responses of another adapter
+
+    Only non streamed GET requests with a URL matching one of the TTL
+    patterns are cached, so the images never end up in the cache. Expired
+    entries with an ETag or Last-Modified header are revalidated.
+    adapter = the wrapped adapter that makes the real requests
+    cache = ResponseCache object
+    ttls = tuple of (regex, seconds) pairs, the first match is used
+    """
+
+    def __init__(self, adapter, cache, ttls):
+        super().__init__()
+        self.adapter = adapter
+        self.cache = cache
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+
+    def get_ttl(self, request):
+        if request.method != "GET" or "Range" in request.headers:
+            return None
+        for pattern, ttl in self.ttls:
+            if pattern.search(request.url):
+                return ttl
+        return None
+
+    def send(self, request, stream=False, **kwargs):
+        ttl = None if stream else self.get_ttl(request)
+        if ttl is None:
+            return self.adapter.send(request, stream=stream, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            status, headers, body, expires = entry
+            if expires > time.time():
+                return self.build_response(request, status, headers, body)
+            validators = CaseInsensitiveDict(headers)
+            if "ETag" in validators:
+                request.headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                request.headers["If-Modified-Since"] = validators["Last-Modified"]
+
+        r = self.adapter.send(request, stream=stream, **kwargs)
+        if r.status_code == 304 and entry is not None:
+            r.close()
+            self.cache.refresh(request.url, ttl)
+            return self.build_response(request, status, headers, body)
+
+        if (
+            r.status_code == 200
+            and not r.headers.get("Content-Type", "").startswith("image/")
+            and "no-store" not in r.headers.get("Cache-Control", "")
+            and len(r.content) <= MAX_ENTRY_SIZE
+        ):
+            # The body is stored decoded
+            headers = {
+                k: v
+                for k, v in r.headers.items()
+                if k.lower() not in ("content-encoding", "transfer-encoding")
+            }
+            headers["Content-Length"] = str(len(r.content))
+            self.cache.put(request.url, 200, headers, r.content, ttl)
+        return r
+
+    def build_response(self, request, status, headers, body):
+        r = requests.Response()
+        r.status_code = status
+        r.reason = "OK"
+        r.headers = CaseInsensitiveDict(headers)
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = body
+        r.url = request.url
+        r.request = request
+        r.connection = self
+        return r
+
+    def close(self):
+        self.adapter.close()
@@ -2,7 +2,7 @@ import json
 import os
 from pathlib import Path
 
-from .modules.manga import BaseManga
+from .modules import find_module
 from .utils import ask_confirmation, ask_number, clean_up_string
 
 DEFAULT_REPLACEMENT_RULES = {
@@ -76,8 +76,11 @@ class Config:
             )
         else:
             self.config_path = self.home / ".config" / "SMD" / "SMD_conf.json"
+        self.state_path = self.config_path.with_name("SMD_state.json")
+        self.cache_path = self.config_path.with_name("SMD_cache.sqlite")
 
         self.load_config()
+        self.load_state()
 
     def __bool__(self):
         return self.status
@@ -112,6 +115,29 @@ class Config:
             print("Covers setting is invalid, should be true or false")
             return
 
+        self.cbz = config.get("cbz", False)
+        if not isinstance(self.cbz, bool):
+            print("CBZ setting is invalid, should be true or false")
+            return
+
+        self.dedupe = config.get("dedupe", False)
+        if not isinstance(self.dedupe, bool):
+            print("Dedupe setting is invalid, should be true or false")
+            return
+
+        self.cache = config.get("cache", False)
+        if not isinstance(self.cache, bool):
+            print("Cache setting is invalid, should be true or false")
+            return
+        try:
+            self.cache_size = int(config.get("cache_size", 50))
+        except ValueError:
+            print("Cache size setting is not a valid number, should be integer")
+            return
+        if self.cache_size < 1:
+            print("Cache size setting is invalid, can't be less than 1")
+            return
+
         self.lang_code = config.get("lang_code", "en").lower()
         if not self.check_language_code(self.lang_code):
             return
@@ -125,6 +151,28 @@ class Config:
             print("Timeout setting is invalid, can't be less than 1")
             return
 
+        try:
+            self.check_workers = int(config.get("check_workers", 4))
+        except ValueError:
+            print("Check workers setting is not a valid number, should be integer")
+            return
+        if self.check_workers < 1:
+            print("Check workers setting is invalid, can't be less than 1")
+            return
+
+        try:
+            self.page_retries = int(config.get("page_retries", 3))
+            self.retry_budget = int(config.get("retry_budget", 100))
+        except ValueError:
+            print("Retry settings are not valid numbers, should be integers")
+            return
+        if self.page_retries < 1:
+            print("Page retries setting is invalid, can't be less than 1")
+            return
+        if self.retry_budget < 0:
+            print("Retry budget setting is invalid, can't be less than 0")
+            return
+
         self.replacement_rules = config.get(
             "character_replacement_rules", DEFAULT_REPLACEMENT_RULES
         )
@@ -137,8 +185,68 @@ class Config:
             print("Data saver setting is invalid, should be true or false")
             return
 
+        try:
+            self.full_resync_days = float(config.get("full_resync_days", 7))
+        except ValueError:
+            print("Full resync setting is not a valid number")
+            return
+        if self.full_resync_days < 0:
+            print("Full resync setting is invalid, can't be less than 0")
+            return
+
+        self.rate_limits = config.get("rate_limits", {})
+        if not self.check_rate_limits(self.rate_limits):
+            print(
+                "Rate limits are invalid, should be dictionary "
+                '(Host: [requests per second, burst]) e.g. {"example.com": [2, 1]}'
+            )
+            return
+
+        self.hedged_modules = config.get("hedged_modules", [])
+        if not isinstance(self.hedged_modules, list) or not all(
+            isinstance(name, str) for name in self.hedged_modules
+        ):
+            print("Hedged modules setting is invalid, should be a list of module names")
+            return
+
+        self.min_throughput = config.get("min_throughput", {})
+        if not self.check_min_throughput(self.min_throughput):
+            print(
+                "Minimum throughput setting is invalid, should be dictionary "
+                '(Module: bytes per second) e.g. {"Mangadex": 20480}'
+            )
+            return
+
         self.status = True
 
+    def load_state(self):
+        """
+        Loads the state file, it only holds things that can be recreated
+        so a broken one is ignored
+        """
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except ValueError:
+            print(f'\nState file "{self.state_path}" is invalid, ignoring it')
+            state = {}
+        if not isinstance(state, dict):
+            state = {}
+        self.feed_marks = state.get("feed_marks", {})
+
+    def save_state(self):
+        """Saves the state file in one step"""
+        state = {"feed_marks": self.feed_marks}
+        tmp = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f, indent=4)
+            tmp.replace(self.state_path)
+        except OSError as e:
+            print(f"Failed to save the state file: {e}")
+
     def add_tracked(self, manga):
         """Adds manga to the tracked list"""
         current_title = manga.series_title
@@ -173,6 +281,7 @@ class Config:
                 print(message)
 
         for r in to_remove:
+            self.feed_marks.pop(self.tracked_manga[r], None)
             del self.tracked_manga[r]
             print(f"Removed from tracked: {r}")
 
@@ -189,7 +298,7 @@ class Config:
         if to_check in self.tracked_manga:
             return (True, to_check)
         elif "/" in to_check:
-            module = BaseManga.find_matching_module(to_check)
+            module = find_module(to_check)
             if module:
                 to_check = module.clean_up_link(to_check)
 
@@ -218,6 +327,7 @@ class Config:
         """Clears the tracked shows"""
         if ask_confirmation("Are you sure you want to clear tracked manga?"):
             self.tracked_manga = {}
+            self.feed_marks = {}
             print("Tracked cleared")
 
     def reset_config(self):
@@ -228,10 +338,21 @@ class Config:
             self.manga_directory = self.home / "Manga"
             self.tracked_manga = {}
             self.covers = False
+            self.cbz = False
+            self.dedupe = False
+            self.cache = False
+            self.cache_size = 50
             self.lang_code = "en"
             self.download_timeout = 5
+            self.check_workers = 4
+            self.page_retries = 3
+            self.retry_budget = 100
+            self.full_resync_days = 7
             self.replacement_rules = DEFAULT_REPLACEMENT_RULES
             self.data_saver = False
+            self.rate_limits = {}
+            self.hedged_modules = []
+            self.min_throughput = {}
             print("Config was reset")
 
     def change_position(self, verbose):
@@ -314,6 +435,38 @@ class Config:
             self.covers = True
             print("Cover download turned on!")
 
+    def toggle_cbz(self):
+        if self.cbz:
+            self.cbz = False
+            print("Chapters will be saved as directories!")
+        else:
+            self.cbz = True
+            print("Chapters will be saved as .cbz archives!")
+
+    def toggle_dedupe(self):
+        if self.dedupe:
+            self.dedupe = False
+            print("Page deduplication turned off!")
+        else:
+            self.dedupe = True
+            print("Page deduplication turned on!")
+
+    def toggle_cache(self):
+        if self.cache:
+            self.cache = False
+            print("Response cache turned off!")
+        else:
+            self.cache = True
+            print("Response cache turned on!")
+
+    def clear_cache(self):
+        from .cache import clear_cache
+
+        if clear_cache(self.cache_path):
+            print("Response cache cleared!")
+        else:
+            print("Response cache is already empty")
+
     def toogle_data_saver(self):
         if self.data_saver:
             self.data_saver = False
@@ -329,12 +482,36 @@ class Config:
         print(self.manga_directory)
         print("\nCovers:")
         print(self.covers)
+        print("\nSave chapters as .cbz:")
+        print(self.cbz)
+        print("\nDeduplicate pages:")
+        print(self.dedupe)
+        print("\nResponse cache:")
+        print(self.cache)
+        print("\nResponse cache size (MiB):")
+        print(self.cache_size)
         print("\nMangadex language code:")
         print(self.lang_code)
         print("\nPage download timeout (s):")
         print(self.download_timeout)
+        print("\nManga checked at the same time:")
+        print(self.check_workers)
+        print("\nPage download attempts:")
+        print(self.page_retries)
+        print("\nRetry budget per run:")
+        print(self.retry_budget)
         print("\nData saver:")
         print(self.data_saver)
+        print("\nDays between full Mangadex feed syncs:")
+        print(self.full_resync_days)
+        print("\nRate limits (requests per second, burst):")
+        for host, (rate, burst) in self.rate_limits.items():
+            print(f'"{host}" -> {rate}, {burst}')
+        print("\nModules with hedged image requests:")
+        print(", ".join(self.hedged_modules) or "None")
+        print("\nMinimum image download throughput (bytes/s):")
+        for module, throughput in self.min_throughput.items():
+            print(f'"{module}" -> {throughput}')
         self.print_replacement_rules()
         print()
 
@@ -361,6 +538,39 @@ class Config:
             print('Use "SMD conf --list_lang" to list available codes')
             return False
 
+    @staticmethod
+    def check_rate_limits(rate_limits):
+        """
+        Checks if the rate limits are a dict of host: [rate, burst]
+        """
+        if not isinstance(rate_limits, dict):
+            return False
+        for limit in rate_limits.values():
+            if not isinstance(limit, list) or len(limit) != 2:
+                return False
+            rate, burst = limit
+            if not isinstance(rate, (int, float)) or rate <= 0:
+                return False
+            if not isinstance(burst, int) or burst < 1:
+                return False
+        return True
+
+    @staticmethod
+    def check_min_throughput(min_throughput):
+        """
+        Checks if the minimum throughput is a dict of module: bytes per second
+        """
+        if not isinstance(min_throughput, dict):
+            return False
+        for throughput in min_throughput.values():
+            if (
+                not isinstance(throughput, (int, float))
+                or isinstance(throughput, bool)
+                or throughput <= 0
+            ):
+                return False
+        return True
+
     def list_lang(self):
         """
         Prints all of the language codes
@@ -380,13 +590,46 @@ class Config:
         self.download_timeout = seconds
         print(f"Timeout changed to {seconds} seconds!")
 
+    def change_check_workers(self, workers):
+        """
+        Changes how many manga are checked at the same time
+        """
+
+        if workers < 1:
+            print("Value must be at least 1!")
+            return
+        self.check_workers = workers
+        print(f"Now checking {workers} manga at the same time!")
+
+    def change_retries(self, attempts):
+        """
+        Changes how many times a page download is attempted
+        """
+
+        if attempts < 1:
+            print("Value must be at least 1!")
+            return
+        self.page_retries = attempts
+        print(f"Page downloads will be attempted up to {attempts} time(s)!")
+
     def save_config(self):
         config = {
             "manga_directory": str(self.manga_directory),
             "covers": self.covers,
+            "cbz": self.cbz,
+            "dedupe": self.dedupe,
+            "cache": self.cache,
+            "cache_size": self.cache_size,
             "lang_code": self.lang_code,
             "page_download_timeout": self.download_timeout,
+            "check_workers": self.check_workers,
+            "page_retries": self.page_retries,
+            "retry_budget": self.retry_budget,
+            "full_resync_days": self.full_resync_days,
             "data_saver": self.data_saver,
+            "rate_limits": self.rate_limits,
+            "hedged_modules": self.hedged_modules,
+            "min_throughput": self.min_throughput,
             "character_replacement_rules": self.replacement_rules,
             "tracking": self.tracked_manga,
         }
@@ -398,6 +641,7 @@ class Config:
 
         with open(self.config_path, "w") as f:
             json.dump(config, f, indent=4)
+        self.save_state()
         return 0
 
     def reset_replacement_rules(self):
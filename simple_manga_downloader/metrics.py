@@ -0,0 +1,117 @@
+"""Exports the run statistics as Prometheus text format metrics."""
+import os
+import time
+
+from .stats import LATENCY_BUCKETS
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+    return f"{{{pairs}}}"
+
+
+class MetricWriter:
+    """Collects the lines of the metrics, every metric is declared once"""
+
+    def __init__(self):
+        self.lines = []
+
+    def declare(self, name, metric_type, help_text):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+
+    def sample(self, name, value, **labels):
+        self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def render(stats):
+    """Returns the metrics of the Stats object in the text format"""
+    writer = MetricWriter()
+    with stats.lock:
+        chapters = dict(stats.chapters)
+        pages = dict(stats.pages)
+        page_bytes = dict(stats.page_bytes)
+        retries = dict(stats.retries)
+        reports = dict(stats.reports)
+        hedges = dict(stats.hedges)
+        status_codes = {
+            host: dict(h["status_codes"]) for host, h in stats.hosts.items()
+        }
+        histograms = {
+            host: (list(h["counts"]), h["sum"])
+            for host, h in stats.latency_histograms.items()
+        }
+
+    writer.declare("smd_run_start_timestamp_seconds", "gauge", "When the run started")
+    writer.sample("smd_run_start_timestamp_seconds", round(stats.start, 3))
+    writer.declare(
+        "smd_run_duration_seconds", "gauge", "How long the run has been going"
+    )
+    writer.sample("smd_run_duration_seconds", round(time.time() - stats.start, 3))
+
+    writer.declare("smd_chapters_total", "counter", "Chapters found/downloaded/failed")
+    for (module, state), count in sorted(chapters.items()):
+        writer.sample("smd_chapters_total", count, module=module, state=state)
+
+    writer.declare("smd_pages_total", "counter", "Downloaded pages")
+    for module, count in sorted(pages.items()):
+        writer.sample("smd_pages_total", count, module=module)
+    writer.declare("smd_page_bytes_total", "counter", "Downloaded page bytes")
+    for module, size in sorted(page_bytes.items()):
+        writer.sample("smd_page_bytes_total", size, module=module)
+
+    writer.declare("smd_http_responses_total", "counter", "HTTP responses")
+    for host, codes in sorted(status_codes.items(), key=lambda h: str(h[0])):
+        for code, count in sorted(codes.items()):
+            writer.sample("smd_http_responses_total", count, host=host, code=code)
+
+    writer.declare(
+        "smd_http_retries_total", "counter", "Requests retried by the session adapters"
+    )
+    for (host, code), count in sorted(retries.items(), key=lambda r: str(r[0])):
+        writer.sample("smd_http_retries_total", count, host=host, code=code)
+
+    writer.declare(
+        "smd_http_hedged_requests_total",
+        "counter",
+        "Second image requests made for slow ones, won if they answered first",
+    )
+    for (host, state), count in sorted(hedges.items(), key=lambda h: str(h[0])):
+        writer.sample("smd_http_hedged_requests_total", count, host=host, state=state)
+
+    writer.declare(
+        "smd_md_at_home_reports_total", "counter", "MangaDex@Home reports by outcome"
+    )
+    for state, count in sorted(reports.items()):
+        writer.sample("smd_md_at_home_reports_total", count, state=state)
+
+    name = "smd_http_request_duration_seconds"
+    writer.declare(name, "histogram", "Time until the response headers arrived")
+    for host, (counts, total) in sorted(histograms.items(), key=lambda h: str(h[0])):
+        count = 0
+        for bucket, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            count += bucket_count
+            writer.sample(f"{name}_bucket", count, host=host, le=bucket)
+        writer.sample(f"{name}_sum", round(total, 6), host=host)
+        writer.sample(f"{name}_count", count, host=host)
+    return writer.text()
+
+
+def write_textfile(stats, path):
+    """
+    Writes the metrics to the file in one step so the node exporter
+    textfile collector never reads a half written file
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render(stats))
+    os.replace(tmp, path)
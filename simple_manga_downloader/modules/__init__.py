@@ -1,31 +1,204 @@
 """The module that handles importing the manga modules and changing their attributes."""
-from .manga import BaseManga
+import re
+from importlib import import_module
+from urllib.parse import urlsplit
 
-# Modules need to be imported so they get registered, order matters
-# isort: off
-from .mangadex_org import Mangadex
-from .mangakakalot_com import Mangakakalot  # noqa: F401
-from .manganato_com import Manganato  # noqa: F401
-from .mangatown_com import Mangatown  # noqa: F401
+from .manga import BaseManga, add_session_setup
+
+
+class ModuleInfo:
+    """What is known about a manga module without importing it
+
+    The module is only imported once a link of it is used, so the site
+    modules and their dependencies don't slow down the start
+    name = name of the module class
+    path = the Python module of the class, relative to this package or
+    absolute for modules of other packages
+    site_re = regex of the links the module handles, it's set as the site_re
+    of the class when it's imported
+    hosts = hostnames of the links the module handles, links are only
+    matched against the modules of their host. Modules without hosts are
+    tried for every link.
+    """
+
+    def __init__(self, name, path, site_re, hosts):
+        self.name = name
+        self.path = path
+        self.site_re = re.compile(site_re)
+        self.hosts = hosts
+        self.module = None
+        # Class attributes that are set once the module is imported
+        self.attributes = {}
+
+    def load(self):
+        """Imports the module class on first use and returns it"""
+        if self.module is None:
+            module = getattr(import_module(self.path, __name__), self.name)
+            module.site_re = self.site_re
+            for name, value in self.attributes.items():
+                setattr(module, name, value)
+            self.module = module
+        return self.module
+
+    def set_attribute(self, name, value):
+        """Sets the class attribute now or once the module is imported"""
+        self.attributes[name] = value
+        if self.module is not None:
+            setattr(self.module, name, value)
+
+    def clean_up_link(self, link):
+        """Returns a cleaned up version of the link"""
+        return self.site_re.search(link).group(0)
+
+
+# Order matters, the first matching module is used
+MODULES = [
+    ModuleInfo(
+        "Mangadex",
+        ".mangadex_org",
+        r"mangadex\.(?:org|cc)/(?:title|manga)/([\w-]+)",
+        ("mangadex.org", "www.mangadex.org", "mangadex.cc"),
+    ),
+    ModuleInfo(
+        "Mangakakalot",
+        ".mangakakalot_com",
+        r"https?://mangakakalot\.com/\S*",
+        ("mangakakalot.com",),
+    ),
+    ModuleInfo(
+        "Manganato",
+        ".manganato_com",
+        r"https?://(?:(?:(?:read)?manganato)|manganelo)\.com/manga(?:/|-)\S*",
+        ("manganato.com", "readmanganato.com", "manganelo.com"),
+    ),
+    ModuleInfo(
+        "Mangatown",
+        ".mangatown_com",
+        r"https?://www\.mangatown\.com/manga/[^\s/]*",
+        ("www.mangatown.com",),
+    ),
+]
+
+# Modules of other packages are found with this entry point group, every
+# entry point has to be a ModuleInfo object
+ENTRY_POINT_GROUP = "simple_manga_downloader.modules"
+
+# hostname -> list of ModuleInfo, built on first use
+_host_index = None
+_hostless = []
+
+
+def entry_points():
+    """Returns the entry points of ENTRY_POINT_GROUP"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python < 3.8
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+    found = entry_points()
+    if hasattr(found, "select"):
+        return list(found.select(group=ENTRY_POINT_GROUP))
+    return list(found.get(ENTRY_POINT_GROUP, []))
+
+
+def load_plugins():
+    """Registers the modules of the installed plugins"""
+    for entry_point in entry_points():
+        try:
+            info = entry_point.load()
+        except Exception as e:
+            print(f'Failed to load the module plugin "{entry_point.name}": {e}')
+            continue
+        if not isinstance(info, ModuleInfo):
+            print(f'Module plugin "{entry_point.name}" is not a ModuleInfo, ignored')
+            continue
+        register_module(info)
+
+
+def index_module(info):
+    if not info.hosts:
+        _hostless.append(info)
+    for host in info.hosts:
+        _host_index.setdefault(host.lower(), []).append(info)
+
+
+def get_host_index():
+    """Returns the hostname index, loads the plugins when first called"""
+    global _host_index
+    if _host_index is None:
+        _host_index = {}
+        for info in MODULES:
+            index_module(info)
+        load_plugins()
+    return _host_index
+
+
+def register_module(info):
+    """Adds a module to the end of MODULES"""
+    MODULES.append(info)
+    if _host_index is not None:
+        index_module(info)
+
+
+def link_host(link):
+    """Returns the hostname of the link, which doesn't need a scheme"""
+    link = link.strip()
+    if "//" not in link:
+        link = f"//{link}"
+    try:
+        return urlsplit(link).hostname
+    except ValueError:
+        return None
+
+
+def find_module(link):
+    """Returns the ModuleInfo of the module matching the link or None"""
+    candidates = get_host_index().get(link_host(link), [])
+    for info in candidates + _hostless:
+        if info.site_re.search(link):
+            return info
+    return None
+
+
+def get_module_info(name):
+    """Returns the ModuleInfo of the module with the given name"""
+    get_host_index()
+    for info in MODULES:
+        if info.name == name:
+            return info
+    raise KeyError(name)
+
+
+def load_module(name):
+    """Returns the module class with the given name, imports it if needed"""
+    return get_module_info(name).load()
 
 
 def match_module(link, title):
     """Initialize the proper module"""
-    module = BaseManga.find_matching_module(link)
-    if module is False:
+    info = find_module(link)
+    if info is None:
         return False
     else:
-        return module(link, title=title)
+        return info.load()(link, title=title)
 
 
 def set_mangadex_language(lang_code):
     """Changes the mangadex language code for all instances"""
-    Mangadex.lang_code = lang_code
+    load_module("Mangadex").lang_code = lang_code
+
+
+def get_mangadex_language():
+    return load_module("Mangadex").lang_code
 
 
 def set_data_saver(flag):
     """Sets the data saver setting"""
-    Mangadex.data_saver = flag
+    load_module("Mangadex").data_saver = flag
 
 
 def toggle_check_only():
@@ -33,9 +206,56 @@ def toggle_check_only():
     BaseManga.check_only = True
 
 
+def prefetch_mangadex(manga_objects):
+    """Prefetches the main info of all of the Mangadex manga in batches"""
+    Mangadex = load_module("Mangadex")
+    Mangadex.prefetch([m for m in manga_objects if isinstance(m, Mangadex)])
+
+
+def flush_reports():
+    """Sends the MangaDex@Home reports that are still queued"""
+    Mangadex = get_module_info("Mangadex").module
+    if Mangadex is not None:
+        Mangadex.reports.flush()
+
+
+def set_download_tuning(hedged, min_throughput):
+    """
+    Turns on request hedging and stall detection for the given modules
+    hedged = list of module names to hedge the image requests of
+    min_throughput = {module name: bytes per second}
+    """
+    settings = [(name, "hedge_requests", True) for name in hedged]
+    settings.extend(
+        (name, "min_throughput", value) for name, value in min_throughput.items()
+    )
+    for name, attribute, value in settings:
+        try:
+            get_module_info(name).set_attribute(attribute, value)
+        except KeyError:
+            print(f'Unknown module "{name}" in the config, ignored')
+
+
 def set_download_directory(path):
     """
     Sets the download directory for all of the modules
     path = pathlib Path object
     """
     BaseManga.directory = path
+
+
+def install_cache(cache):
+    """Wraps the adapters of all module sessions with the response cache"""
+    # Only imported when the cache is used because it needs requests
+    from ..cache import CachingAdapter
+
+    def wrap_adapters(module, session):
+        for prefix, adapter in session.adapters.items():
+            session.adapters[prefix] = CachingAdapter(adapter, cache, module.cache_ttls)
+
+    add_session_setup(wrap_adapters)
+
+
+def add_response_hook(hook):
+    """Adds a requests response hook to the sessions of all modules"""
+    add_session_setup(lambda module, session: session.hooks["response"].append(hook))
@@ -1,4 +1,48 @@
-from ..utils import ask_number
+import threading
+
+from ..utils import ask_number, get_limiter, interactive
+
+# Functions called with (module, session) for every new module session
+_session_setups = []
+
+
+class LazySession:
+    """Class attribute that gives every module its own requests session
+
+    The session is only created the first time it's used, then set up by the
+    setup_session of the module and the functions added with add_session_setup
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.RLock()
+
+    def __get__(self, instance, owner):
+        session = self.sessions.get(owner)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(owner)
+                if session is None:
+                    # Importing requests is a big part of the startup time
+                    import requests
+
+                    session = requests.Session()
+                    owner.setup_session(session)
+                    for setup in _session_setups:
+                        setup(owner, session)
+                    self.sessions[owner] = session
+        return session
+
+
+def add_session_setup(setup):
+    """
+    Adds a function that is called with (module, session) for the session of
+    every module, sessions that already exist are set up right away
+    """
+    with BaseManga.__dict__["session"].lock:
+        _session_setups.append(setup)
+        for module, session in BaseManga.__dict__["session"].sessions.items():
+            setup(module, session)
 
 
 class BaseManga:
@@ -6,28 +50,42 @@ class BaseManga:
     directory = manga download directory Path object
     check_only if True will cause all of the manga modules to not ask for
     user input
+    page_workers = how many pages of a chapter are downloaded at the same
+    time, modules can override it to fit the site
+    rate_limit, rate_burst = the default token bucket settings for the hosts
+    the module downloads images from, every host gets its own bucket
+    feed_mark = what the module saved about the chapter list in the last
+    update, like the newest update time or the validators of the manga page,
+    modules that support it only get what changed since then
+    new_feed_mark = the mark to save once the new chapters are downloaded,
+    None if the module doesn't support it
+    cache_ttls = (regex, seconds) pairs of the URLs the response cache can
+    keep and for how long, the first matching pattern is used
+    session = the requests session of the module, created on first use
+    site_re = regex of the links the module handles, set from the ModuleInfo
+    of the module when it's imported
+    hedge_requests = if True a second request is made for an image when the
+    first one takes longer than the p95 response time of its host, the one
+    that answers first is used
+    min_throughput = bytes per second an image download has to keep up or it
+    is stopped and retried, None to never stop it
     """
 
-    _all_modules = []
+    session = LazySession()
     directory = None
     check_only = False
+    page_workers = 4
+    rate_limit = 2
+    rate_burst = 1
+    feed_mark = None
+    new_feed_mark = None
+    cache_ttls = ()
+    hedge_requests = False
+    min_throughput = None
 
-    def __init_subclass__(cls, **kwargs):
-        BaseManga._all_modules.append(cls)
-        super().__init_subclass__(**kwargs)
-
-    @staticmethod
-    def find_matching_module(link):
-        """Looks for a matching module
-
-        If it finds a matching module returns it uninitialized,
-        else returns False
-        """
-        for module in BaseManga._all_modules:
-            if module.check_if_link_matches(link):
-                return module
-        else:
-            return False
+    @classmethod
+    def setup_session(cls, session):
+        """Sets up the new session of the module, like headers and adapters"""
 
     @property
     def manga_dir(self):
@@ -44,11 +102,54 @@ class BaseManga:
         """Checks if given url is valid for given module"""
         return cls.site_re.search(link)
 
+    @classmethod
+    def get_limiter(cls, link):
+        """Returns the rate limiter for the host of the link"""
+        return get_limiter(link, cls.rate_limit, cls.rate_burst)
+
     @classmethod
     def clean_up_link(cls, link):
         """Returns a cleaned up version of the link"""
         return cls.check_if_link_matches(link).group(0)
 
+    def get_page_link(self, data, n):
+        """Returns the link of page n of the chapter data"""
+        return data["pages"][n]
+
+    def page_downloaded(self, data, n, link, duration):
+        """Called after page n was downloaded from the link in duration seconds"""
+
+    def page_failed(self, data, n, link, error):
+        """
+        Called when page n failed to download from the link
+        error = the error message
+        Returns another link to try the page with or None to give up
+        """
+        return None
+
+    def conditional_get(self, link, **kwargs):
+        """
+        Makes a GET request with the validators from the feed mark
+        Returns the response, it's 304 if nothing changed since the mark
+        """
+        headers = {}
+        if self.feed_mark is not None:
+            if "etag" in self.feed_mark:
+                headers["If-None-Match"] = self.feed_mark["etag"]
+            if "last_modified" in self.feed_mark:
+                headers["If-Modified-Since"] = self.feed_mark["last_modified"]
+        r = self.session.get(link, headers=headers, **kwargs)
+        if r.status_code == 304:
+            self.new_feed_mark = self.feed_mark
+        else:
+            validators = {}
+            if "ETag" in r.headers:
+                validators["etag"] = r.headers["ETag"]
+            if "Last-Modified" in r.headers:
+                validators["last_modified"] = r.headers["Last-Modified"]
+            self.new_feed_mark = validators or None
+        return r
+
     def ask_for_chapter_number(self, title, taken=False, num=None):
         """Asks for user input to get a chapter number
 
@@ -63,6 +164,17 @@ class BaseManga:
         if self.check_only:
             return False
 
+        inp = interactive(self.chapter_number_prompt, title, taken, num)
+        if inp is False:
+            return False
+        elif inp.is_integer():
+            return int(inp)
+        else:
+            return inp
+
+    @staticmethod
+    def chapter_number_prompt(title, taken, num):
+        """The prompt of ask_for_chapter_number"""
         if taken:
             if title:
                 print(f'Chapter number already taken for Chapter {num}, "{title}"')
@@ -77,9 +189,4 @@ class BaseManga:
             num_type=float,
         )
         print()
-        if inp is False:
-            return False
-        elif inp.is_integer():
-            return int(inp)
-        else:
-            return inp
+        return inp
@@ -1,13 +1,41 @@
 import html
+import queue
 import re
+import threading
 import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
 import requests
 from requests.packages.urllib3.util.retry import Retry
 
-from ..utils import clean_up_string, request_exception_handler
+from ..stats import STATS
+from ..utils import clean_up_string, interactive, request_exception_handler
 from .manga import BaseManga
 
+# How many MangaDex@Home reports can wait to be sent, new ones are dropped
+# once it's full
+REPORT_QUEUE_SIZE = 200
+# How many seconds the reports that are left at the end can take to be sent
+REPORT_FLUSH_TIMEOUT = 5
+# Pages that take longer than this many seconds are slow for the node
+NODE_SLOW_PAGE = 10
+# A node isn't used any more after this many slow pages in a row
+NODE_MAX_SLOW = 3
+# How many times a chapter can ask the API for a MangaDex@Home node
+MAX_NODE_REQUESTS = 3
+
+
+class CountingRetry(Retry):
+    """Retry that counts the retries caused by a bad status in the run stats"""
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        if response is not None:
+            pool = kwargs.get("_pool")
+            host = pool.host if pool is not None else None
+            STATS.record_retry(host, response.status)
+        return super().increment(method, url, response, *args, **kwargs)
+
 
 class Limiter(requests.adapters.HTTPAdapter):
     """Rate-limiting HTTAdapter
@@ -21,7 +49,7 @@ class Limiter(requests.adapters.HTTPAdapter):
     def __init__(self, limit=6, backoff_factor=1, status_forcelist=None, **kwargs):
         if status_forcelist is None:
             status_forcelist = [429]
-        r = Retry(
+        r = CountingRetry(
             status=limit,
             total=None,
             connect=0,
@@ -35,54 +63,218 @@ class Limiter(requests.adapters.HTTPAdapter):
         super().__init__(max_retries=r, **kwargs)
 
 
+class ReportQueue:
+    """Sends the MangaDex@Home reports from a background thread
+
+    The downloads only queue the reports so they never wait for the report
+    endpoint, reports that don't fit in the queue are dropped and counted
+    """
+
+    link = "https://api.mangadex.network/report"
+
+    def __init__(self, size=REPORT_QUEUE_SIZE):
+        self.queue = queue.Queue(size)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, report):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.worker, name="MD@Home reports", daemon=True
+                )
+                self.thread.start()
+        try:
+            self.queue.put_nowait(report)
+        except queue.Full:
+            STATS.record_report("dropped")
+
+    def worker(self):
+        # Own session so the reports don't share the connections of the images
+        session = requests.Session()
+        while True:
+            report = self.queue.get()
+            if report is None:
+                break
+            try:
+                r = session.post(self.link, json=report, timeout=1)
+            except requests.RequestException:
+                STATS.record_report("failed")
+            else:
+                STATS.record_report("sent" if r.ok else "failed")
+        session.close()
+
+    def flush(self, timeout=REPORT_FLUSH_TIMEOUT):
+        """Sends the queued reports and stops the worker
+
+        Waits at most timeout seconds, reports that weren't sent by then
+        are counted as dropped
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        else:
+            thread.join(max(0, deadline - time.monotonic()))
+        if thread.is_alive():
+            STATS.record_report("dropped", self.queue.qsize())
+
+
+class NodeHealth:
+    """Keeps track of the MangaDex@Home nodes during the run
+
+    Nodes that failed a page (after the retries) or were slow for
+    NODE_MAX_SLOW pages in a row are marked as down and not used again
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}
+
+    def node(self, base_url):
+        return self.nodes.setdefault(
+            base_url, {"pages": 0, "failed": 0, "slow": 0, "down": False}
+        )
+
+    def downloaded(self, base_url, duration):
+        """Records a downloaded page, returns True if the node is now down"""
+        with self.lock:
+            node = self.node(base_url)
+            node["pages"] += 1
+            if duration < NODE_SLOW_PAGE:
+                node["slow"] = 0
+                return False
+            node["slow"] += 1
+            if node["slow"] >= NODE_MAX_SLOW and not node["down"]:
+                node["down"] = True
+                return True
+            return False
+
+    def failed(self, base_url):
+        with self.lock:
+            node = self.node(base_url)
+            node["failed"] += 1
+            node["down"] = True
+
+    def is_down(self, base_url):
+        with self.lock:
+            return base_url in self.nodes and self.nodes[base_url]["down"]
+
+
 class ReporterLimiter(Limiter):
     """A request limiter that sends reports on image download
 
-    session = requests.Session object used for making the report
+    reports = ReportQueue object the reports are sent with
     """
 
     md_at_home_re = re.compile(r"https://(?:[\w\d]+\.){2}mangadex\.network")
 
-    def __init__(self, session, **kwargs):
-        self.session = session
+    def __init__(self, reports, **kwargs):
+        self.reports = reports
         super().__init__(5, 0, **kwargs)
 
     def send(self, request, **kwargs):
-        if self.md_at_home_re.match(request.url):
-            before = time.time()
-            r = super().send(request, **kwargs)
-            difference = (time.time() - before) * 1000
-            report = {
+        if not self.md_at_home_re.match(request.url):
+            return super().send(request, **kwargs)
+        start = time.monotonic()
+        r = super().send(request, **kwargs)
+        TransferReport(r, start, self.reports)
+        return r
+
+
+class TransferReport:
+    """Reports the MangaDex@Home image response once its body is read
+
+    Wraps iter_content and close of the response so the bytes and time are
+    counted while the body is streamed instead of reading it all at once.
+    The report is queued when the body was fully read or the response
+    closed, responses with an error status are reported right away.
+    Responses closed because they lost a hedge aren't reported.
+    response = requests.Response object of the image
+    start = time.monotonic() from before the request was sent
+    reports = ReportQueue object the report is sent with
+    """
+
+    def __init__(self, response, start, reports):
+        self.response = response
+        self.start = start
+        self.reports = reports
+        self.size = 0
+        self.complete = False
+        self.reported = False
+        self.lock = threading.Lock()
+        if response.status_code not in (200, 206):
+            self.finish()
+            return
+        self.iter_content = response.iter_content
+        self.close = response.close
+        response.iter_content = self.counting_iter_content
+        response.close = self.closing_close
+
+    def counting_iter_content(self, *args, **kwargs):
+        try:
+            for chunk in self.iter_content(*args, **kwargs):
+                self.size += len(chunk)
+                yield chunk
+            self.complete = True
+        finally:
+            self.finish()
+
+    def closing_close(self):
+        self.close()
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.reported:
+                return
+            self.reported = True
+        r = self.response
+        if getattr(r, "hedge_loser", False):
+            return
+        success = self.complete
+        self.reports.put(
+            {
                 "url": r.url,
-                "bytes": len(r.content),
-                "duration": difference,
+                "success": success,
+                "cached": success and r.headers.get("X-Cache", "").startswith("HIT"),
+                "bytes": self.size,
+                "duration": (time.monotonic() - self.start) * 1000,
             }
-            if r.status_code == 200:
-                report["success"] = True
-                if r.headers.get("X-Cache", "").startswith("HIT"):
-                    report["cached"] = True
-                else:
-                    report["cached"] = False
-            else:
-                report["success"] = False
-                report["cached"] = False
-            self.session.post(
-                "https://api.mangadex.network/report", json=report, timeout=1
-            )
-        else:
-            r = super().send(request, **kwargs)
-        return r
+        )
 
 
 class Mangadex(BaseManga):
     base_link = "https://api.mangadex.org"
+    uploads_link = "https://uploads.mangadex.org"
     lang_code = "en"
-    session = requests.Session()
-    session.mount("https://", ReporterLimiter(session))
-    session.mount("https://api.mangadex.org/at-home/server/", Limiter())
-    site_re = re.compile(r"mangadex\.(?:org|cc)/(?:title|manga)/([\w-]+)")
     data_saver = False
+    # Mangadex@Home nodes are separate hosts that can handle bursts
+    rate_limit = 4
+    rate_burst = 4
     scanlation_cache = {}
+    cache_ttls = (
+        (r"/manga/[\w-]+/feed", 10 * 60),
+        (r"/chapter\?", 10 * 60),
+        (r"/cover\?", 24 * 60 * 60),
+        (r"/manga(?:/[\w-]+)?(?:\?|$)", 24 * 60 * 60),
+    )
+    # How many manga are prefetched with one request, the API maximum
+    batch_size = 100
+    reports = ReportQueue()
+    nodes = NodeHealth()
+    node_lock = threading.Lock()
+
+    @classmethod
+    def setup_session(cls, session):
+        session.mount("https://", ReporterLimiter(cls.reports))
+        session.mount("https://api.mangadex.org/at-home/server/", Limiter())
 
     def __init__(self, link, title=None):
         if title:
@@ -93,6 +285,8 @@ class Mangadex(BaseManga):
         self.manga_link = f"https://mangadex.org/title/{self.id}"
         self.covers = {}
         self.chapters = {}
+        self.data = None
+        self.prefetched = False
 
     @request_exception_handler
     def get_main(self, title_return=False):
@@ -100,41 +294,130 @@ class Mangadex(BaseManga):
         Gets the main manga info like title, cover url and chapter links
         using the mangadex API
         title_return=True will only get the title and return
+        Manga that were prefetched only need to get what is missing
         """
-        data = self.make_get_request(f"/manga/{self.id}")["data"]
+        if not self.prefetched:
+            data = self.make_get_request(f"/manga/{self.id}")["data"]
+            self.set_title(data)
+            if title_return:
+                return True
+
+            cover_params = {"manga[]": self.id, "order[volume]": "asc"}
+            self.set_covers(
+                self.request_paginator(cover_params, 100, "/cover", raise_status=True)
+            )
 
+        if self.data is None:
+            feed_params = self.feed_params()
+            if self.feed_mark is not None:
+                # Only the chapters that changed since the last update
+                feed_params["updatedAtSince"] = self.feed_mark[:19]
+            self.set_data(
+                self.request_paginator(feed_params, 500, f"/manga/{self.id}/feed")
+            )
+        return True
+
+    @classmethod
+    def prefetch(cls, manga_objects):
+        """
+        Gets the main info of many manga at once using the list endpoints
+        The titles and covers are fetched for every manga, the chapters
+        only for the manga with a feed mark because the list endpoints can't
+        page through more than 10000 results. Manga that fail to prefetch
+        are left for get_main.
+        """
+        for start in range(0, len(manga_objects), cls.batch_size):
+            batch = manga_objects[start : start + cls.batch_size]
+            status = cls.prefetch_batch(batch)
+            if status is not True:
+                print(f"Failed to prefetch {len(batch)} manga, skipping\n{status}")
+
+    @classmethod
+    @request_exception_handler
+    def prefetch_batch(cls, batch):
+        by_id = {manga.id: manga for manga in batch}
+        ids = list(by_id)
+        found = cls.request_paginator(
+            {"ids[]": ids}, cls.batch_size, "/manga", raise_status=True
+        )
+        covers = {manga_id: [] for manga_id in ids}
+        cover_params = {"manga[]": ids, "order[volume]": "asc"}
+        for cover in cls.request_paginator(cover_params, 100, "/cover"):
+            covers.setdefault(related_id(cover, "manga"), []).append(cover)
+
+        incremental = [m for m in batch if m.feed_mark is not None]
+        data = {manga.id: [] for manga in incremental}
+        if incremental:
+            chapter_params = cls.feed_params()
+            chapter_params["manga[]"] = list(data)
+            # The oldest mark, the others just get a few chapters twice
+            since = min(manga.feed_mark for manga in incremental)
+            chapter_params["updatedAtSince"] = since[:19]
+            for chapter in cls.request_paginator(chapter_params, 100, "/chapter"):
+                data.setdefault(related_id(chapter, "manga"), []).append(chapter)
+
+        for manga_data in found:
+            manga = by_id.get(manga_data["id"])
+            if manga is None:
+                continue
+            manga.set_title(manga_data)
+            manga.set_covers(covers[manga.id])
+            if manga.id in data:
+                manga.set_data(data[manga.id])
+            manga.prefetched = True
+        return True
+
+    @classmethod
+    def feed_params(cls):
+        return {
+            "translatedLanguage[]": cls.lang_code,
+            "order[volume]": "asc",
+            "order[chapter]": "asc",
+            "includes[]": "scanlation_group",
+        }
+
+    def set_title(self, data):
         if self.series_title is None:
             self.series_title = clean_up_string(
                 data["attributes"]["title"].popitem()[1]
             )
-        if title_return:
-            return True
 
-        cover_params = {"manga[]": self.id, "order[volume]": "asc"}
-        for cover in self.request_paginator(
-            cover_params, 100, "/cover", raise_status=True
-        ):
+    def set_covers(self, covers):
+        for cover in covers:
             attr = cover["attributes"]
             volume = attr["volume"]
             if volume is not None:
                 cover_name = f"{self.series_title} Vol {volume.replace(',', '.')}"
             else:
                 cover_name = f"{self.series_title}"
-            url = f"https://uploads.mangadex.org/covers/{self.id}/{attr['fileName']}"
+            url = f"{self.uploads_link}/covers/{self.id}/{attr['fileName']}"
             if self.data_saver:
                 url += ".256.jpg"
             self.covers[cover_name] = url
 
-        feed_params = {
-            "translatedLanguage[]": self.lang_code,
-            "order[volume]": "asc",
-            "order[chapter]": "asc",
-            "includes[]": "scanlation_group",
-        }
-        self.data = self.request_paginator(feed_params, 500, f"/manga/{self.id}/feed")
-        return True
-
-    def request_paginator(self, params, limit, endpoint, raise_status=True):
+    def set_data(self, data):
+        """
+        Sets the chapter feed data and the new feed mark
+        Chapters with a future publishAt don't change once they get published,
+        so the mark is kept at or before them until they are
+        """
+        self.data = data
+        updated = [c["attributes"].get("updatedAt") or "" for c in data]
+        if self.feed_mark is not None:
+            updated.append(self.feed_mark)
+        mark = max(updated, default=None) or None
+        now = datetime.now(timezone.utc).isoformat()[:19]
+        unpublished = [
+            c["attributes"].get("updatedAt") or ""
+            for c in data
+            if (c["attributes"].get("publishAt") or "")[:19] > now
+        ]
+        if mark is not None and unpublished:
+            mark = min(mark, min(unpublished)) or None
+        self.new_feed_mark = mark
+
+    @classmethod
+    def request_paginator(cls, params, limit, endpoint, raise_status=True):
         """Will paginate over the results if needed
 
         params: is a dictionary with the query parameters to use
@@ -146,20 +429,21 @@ class Mangadex(BaseManga):
         params["limit"] = limit
         params["offset"] = 0
         results = []
-        while True:
-            r = self.session.get(f"{self.base_link}{endpoint}", params=params)
-            if raise_status:
-                r.raise_for_status()
-            else:
-                if not r.ok:
-                    continue
-            data = r.json()
-            if data["result"] == "ok":
-                results.extend(data["data"])
-            if limit + params["offset"] >= data["total"]:
-                break
-            else:
-                params["offset"] += limit
+        with STATS.phase("request_paginator"):
+            while True:
+                r = cls.session.get(f"{cls.base_link}{endpoint}", params=params)
+                if raise_status:
+                    r.raise_for_status()
+                else:
+                    if not r.ok:
+                        continue
+                data = r.json()
+                if data["result"] == "ok":
+                    results.extend(data["data"])
+                if limit + params["offset"] >= data["total"]:
+                    break
+                else:
+                    params["offset"] += limit
         return results
 
     def get_chapters(self):
@@ -185,6 +469,8 @@ class Mangadex(BaseManga):
             elif title:
                 inp = self.ask_for_chapter_number(title)
                 if inp is False:
+                    # The skipped chapter has to be in the feed again next time
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
@@ -211,6 +497,7 @@ class Mangadex(BaseManga):
             if num in self.chapters and all_groups in self.chapters[num]:
                 inp = self.ask_for_chapter_number(title, taken=True, num=num)
                 if inp is False:
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
@@ -247,28 +534,36 @@ class Mangadex(BaseManga):
         if self.check_only:
             select = 1
         else:
-            print(f"Multiple groups for chapter {ch}, select one by number:")
-            selections = []
-            for n, g in enumerate(sorted_groups, 1):
-                print(f"{n}.{g}")
-                selections.append(n)
-
-            try:
-                select = int(
-                    input(
-                        "Enter the number of the group [invalid input will skip chapter]:"
-                    )
-                )
-            except ValueError:
-                select = len(sorted_groups) + 1
-            if select not in selections:
+            select = interactive(self.group_prompt, ch, sorted_groups)
+            if select is None:
                 return "Invalid input, skipping chapter"
-            print()
 
         group = sorted_groups[select - 1]
         self.chapters[ch] = self.chapters[ch][release_mapping[group]]
         return True
 
+    @staticmethod
+    def group_prompt(ch, sorted_groups):
+        """The prompt of check_groups, returns the selected number or None"""
+        print(f"Multiple groups for chapter {ch}, select one by number:")
+        selections = []
+        for n, g in enumerate(sorted_groups, 1):
+            print(f"{n}.{g}")
+            selections.append(n)
+
+        try:
+            select = int(
+                input(
+                    "Enter the number of the group [invalid input will skip chapter]:"
+                )
+            )
+        except ValueError:
+            select = len(sorted_groups) + 1
+        if select not in selections:
+            return None
+        print()
+        return select
+
     @request_exception_handler
     def get_info(self, ch):
         """Gets the data about the specific chapters using the mangadex API"""
@@ -278,24 +573,99 @@ class Mangadex(BaseManga):
         if groups is not True:
             return groups
 
-        ch_id = self.chapters[ch]["ch_id"]
-        data = self.make_get_request(f"/at-home/server/{ch_id}")
-
-        server = data["baseUrl"]
-        chapter_hash = data["chapter"]["hash"]
+        chapter = self.chapters[ch]
+        data = self.make_get_request(f"/at-home/server/{chapter['ch_id']}")
 
+        base_url = data["baseUrl"]
+        if self.nodes.is_down(base_url):
+            base_url = self.uploads_link
         if self.data_saver:
-            url = f"{server}/data-saver/{chapter_hash}/"
-            pages = [f"{url}{page}" for page in data["chapter"]["dataSaver"]]
+            quality = "data-saver"
+            files = data["chapter"]["dataSaver"]
         else:
-            url = f"{server}/data/{chapter_hash}/"
-            pages = [f"{url}{page}" for page in data["chapter"]["data"]]
-        self.chapters[ch]["pages"] = pages
+            quality = "data"
+            files = data["chapter"]["data"]
+        # The pages are downloaded from the current node, it can change
+        # while the chapter is being downloaded
+        chapter["at_home"] = {
+            "base_url": base_url,
+            "hash": data["chapter"]["hash"],
+            "quality": quality,
+            "files": files,
+            "node_requests": 1,
+        }
+        chapter["pages"] = [self.get_page_link(chapter, n) for n in range(len(files))]
 
         return True
 
+    def get_page_link(self, data, n):
+        at_home = data.get("at_home")
+        if at_home is None:
+            return super().get_page_link(data, n)
+        return (
+            f"{at_home['base_url']}/{at_home['quality']}/"
+            f"{at_home['hash']}/{at_home['files'][n]}"
+        )
+
+    def page_downloaded(self, data, n, link, duration):
+        if "at_home" not in data:
+            return
+        base_url = link.rsplit("/", 3)[0]
+        if base_url != self.uploads_link and self.nodes.downloaded(base_url, duration):
+            self.switch_node(data, base_url, "too slow")
+
+    def page_failed(self, data, n, link, error):
+        """Moves the rest of the chapter to another node if the node failed"""
+        if "at_home" not in data:
+            return None
+        base_url = link.rsplit("/", 3)[0]
+        if base_url == self.uploads_link:
+            return None
+        self.nodes.failed(base_url)
+        self.switch_node(data, base_url, error)
+        return self.get_page_link(data, n)
+
+    def switch_node(self, data, base_url, reason):
+        """
+        Gets a new MangaDex@Home node for the chapter, falls back to the
+        uploads server if there is no working node
+        base_url = the node that is down
+        """
+        with self.node_lock:
+            at_home = data["at_home"]
+            if at_home["base_url"] != base_url:
+                # Another page already switched the node
+                return
+            new_url = self.uploads_link
+            if at_home["node_requests"] < MAX_NODE_REQUESTS:
+                at_home["node_requests"] += 1
+                try:
+                    new = self.make_get_request(f"/at-home/server/{data['ch_id']}")
+                except (requests.RequestException, ValueError):
+                    new = {}
+                candidate = new.get("baseUrl")
+                if (
+                    candidate
+                    and candidate != base_url
+                    and new.get("chapter", {}).get("hash") == at_home["hash"]
+                    and not self.nodes.is_down(candidate)
+                ):
+                    new_url = candidate
+            at_home["base_url"] = new_url
+        print(
+            f"    MangaDex@Home node {urlsplit(base_url).netloc} is down "
+            f"({reason}), switching to {urlsplit(new_url).netloc}"
+        )
+
     def make_get_request(self, url, **kwargs):
         """Simple helper method that makes a request, checks status and returns JSON"""
         r = self.session.get(f"{self.base_link}{url}", timeout=5, **kwargs)
         r.raise_for_status()
         return r.json()
+
+
+def related_id(item, relationship_type):
+    """Returns the ID of the first relationship of the given type"""
+    for r in item["relationships"]:
+        if r["type"] == relationship_type:
+            return r["id"]
@@ -1,6 +1,5 @@
 import re
 
-import requests
 from bs4 import BeautifulSoup
 
 from ..utils import clean_up_string, request_exception_handler
@@ -9,9 +8,14 @@ from .manga import BaseManga
 
 class Mangakakalot(BaseManga):
     base_link = "https://mangakakalot.com"
-    session = requests.Session()
-    session.headers.update({"Referer": base_link})
-    site_re = re.compile(r"https?://mangakakalot\.com/\S*")
+    cache_ttls = (
+        (r"mangakakalot\.com/chapter/", 24 * 60 * 60),
+        (r"mangakakalot\.com/", 10 * 60),
+    )
+
+    @classmethod
+    def setup_session(cls, session):
+        session.headers.update({"Referer": cls.base_link})
 
     def __init__(self, link, title=None):
         if title:
@@ -28,8 +32,12 @@ class Mangakakalot(BaseManga):
         Gets the main manga info like title, cover url and chapter links
         title_return=True will only get the title and return
         """
-        r = self.session.get(self.manga_link, timeout=5)
+        r = self.conditional_get(self.manga_link, timeout=5)
         r.raise_for_status()
+        if r.status_code == 304:
+            # Nothing changed since the last update
+            self.data = []
+            return True
         soup = BeautifulSoup(r.text, "html.parser")
         if "Sorry, the page you have requested cannot be found" in r.text:
             return "HTTP code error: 404 Client Error"
@@ -76,6 +84,8 @@ class Mangakakalot(BaseManga):
             if num in self.chapters:
                 inp = self.ask_for_chapter_number(title, taken=True, num=num)
                 if inp is False:
+                    # The skipped chapter has to be in the feed again next time
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
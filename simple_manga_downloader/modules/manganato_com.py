@@ -1,6 +1,5 @@
 import re
 
-import requests
 from bs4 import BeautifulSoup
 
 from ..utils import clean_up_string, request_exception_handler
@@ -9,12 +8,15 @@ from .manga import BaseManga
 
 class Manganato(BaseManga):
     base_link = "https://manganato.com/"
-    session = requests.Session()
-    session.headers.update({"Referer": base_link})
-    site_re = re.compile(
-        r"https?://(?:(?:(?:read)?manganato)|manganelo)\.com/manga(?:/|-)\S*"
+    cache_ttls = (
+        (r"/chapter-[\d.-]+$", 24 * 60 * 60),
+        (r"/manga-[\w-]+$", 10 * 60),
     )
 
+    @classmethod
+    def setup_session(cls, session):
+        session.headers.update({"Referer": cls.base_link})
+
     def __init__(self, link, title=None):
         if title:
             self.series_title = clean_up_string(title)
@@ -30,8 +32,12 @@ class Manganato(BaseManga):
         Gets the main manga info like title, cover url and chapter links
         title_return=True will only get the title and return
         """
-        r = self.session.get(self.manga_link, timeout=5)
+        r = self.conditional_get(self.manga_link, timeout=5)
         r.raise_for_status()
+        if r.status_code == 304:
+            # Nothing changed since the last update
+            self.data = []
+            return True
         if "404 - PAGE NOT FOUND" in r.text:
             return "HTTP code error: 404 Client Error"
         soup = BeautifulSoup(r.text, "html.parser")
@@ -69,6 +75,8 @@ class Manganato(BaseManga):
                 title = chapter.text
                 inp = self.ask_for_chapter_number(title)
                 if inp is False:
+                    # The skipped chapter has to be in the feed again next time
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
@@ -76,6 +84,7 @@ class Manganato(BaseManga):
             if num in self.chapters:
                 inp = self.ask_for_chapter_number(title, taken=True, num=num)
                 if inp is False:
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
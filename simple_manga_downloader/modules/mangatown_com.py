@@ -1,6 +1,5 @@
 import re
 
-import requests
 from bs4 import BeautifulSoup
 
 from ..utils import clean_up_string, request_exception_handler
@@ -9,8 +8,11 @@ from .manga import BaseManga
 
 class Mangatown(BaseManga):
     base_link = "https://www.mangatown.com/"
-    session = requests.Session()
-    site_re = re.compile(r"https?://www\.mangatown\.com/manga/[^\s/]*")
+    page_workers = 2
+    cache_ttls = (
+        (r"mangatown\.com/+manga/[^/]+/(?:v\d+/)?c[\d.]+/", 24 * 60 * 60),
+        (r"mangatown\.com/+manga/[^/]+/?$", 10 * 60),
+    )
 
     def __init__(self, link, title=None):
         if title:
@@ -27,8 +29,12 @@ class Mangatown(BaseManga):
         Gets the main manga info like title, cover url and chapter links
         title_return=True will only get the title and return
         """
-        r = self.session.get(self.manga_link, timeout=5, allow_redirects=False)
+        r = self.conditional_get(self.manga_link, timeout=5, allow_redirects=False)
         r.raise_for_status()
+        if r.status_code == 304:
+            # Nothing changed since the last update
+            self.data = []
+            return True
         if r.status_code == 302:
             return "HTTP code error: 404 Client Error"
         soup = BeautifulSoup(r.text, "html.parser")
@@ -73,6 +79,8 @@ class Mangatown(BaseManga):
             if ch_num in self.chapters:
                 inp = self.ask_for_chapter_number(chapter_title, taken=True, num=ch_num)
                 if inp is False:
+                    # The skipped chapter has to be in the feed again next time
+                    self.new_feed_mark = None
                     continue
                 else:
                     num = inp
@@ -0,0 +1,286 @@
+"""Collects timing and request statistics about the run."""
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from . import utils
+
+# Upper bounds of the request latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# How many of the latest latencies of every host the percentiles use
+LATENCY_SAMPLES = 10000
+
+
+class Stats:
+    """Thread-safe collector of the run statistics
+
+    Phases are timed per manga, requests are counted for the innermost phase
+    of the thread that made them and for their host. The time of the
+    outermost phases is also added to the total time of the manga.
+    The latencies are counted in the LATENCY_BUCKETS histogram of their host,
+    only the latest LATENCY_SAMPLES are kept for the percentiles.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = defaultdict(
+            lambda: {"calls": 0, "time": 0.0, "requests": 0, "bytes": 0}
+        )
+        self.hosts = defaultdict(
+            lambda: {
+                "requests": 0,
+                "bytes": 0,
+                "latencies": deque(maxlen=LATENCY_SAMPLES),
+                "status_codes": Counter(),
+            }
+        )
+        # host -> request count of every bucket (the last one is +Inf) and
+        # the sum of the latencies
+        self.latency_histograms = defaultdict(
+            lambda: {"counts": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0}
+        )
+        self.manga_time = defaultdict(float)
+        # (module, "found"/"downloaded"/"failed") -> chapter count
+        self.chapters = Counter()
+        self.pages = Counter()
+        self.page_bytes = Counter()
+        # (host, status code) -> retries made by the session adapters
+        self.retries = Counter()
+        # MangaDex@Home reports sent/failed/dropped
+        self.reports = Counter()
+        # (host, "started"/"won") -> hedged requests, won if the second
+        # request answered first
+        self.hedges = Counter()
+        self.start = time.time()
+
+    @contextmanager
+    def phase(self, name, manga=None):
+        """Times the phase, manga is the title of the manga it's for
+
+        Nested phases without a manga belong to the manga of the outer phase
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        if manga is None and stack:
+            manga = stack[-1][0]
+        outermost = not stack
+        stack.append((manga, name))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                phase = self.phases[(manga, name)]
+                phase["calls"] += 1
+                phase["time"] += duration
+                if outermost:
+                    self.manga_time[manga] += duration
+
+    def record_response(self, response, *args, **kwargs):
+        """requests response hook, counts the request and its latency
+
+        The size comes from the Content-Length header so streamed responses
+        don't have to be read
+        """
+        host = urlsplit(response.url).hostname
+        try:
+            size = int(response.headers.get("Content-Length", 0))
+        except ValueError:
+            size = 0
+        latency = response.elapsed.total_seconds()
+        bucket = bisect_left(LATENCY_BUCKETS, latency)
+        stack = getattr(self.local, "stack", None)
+        with self.lock:
+            stats = self.hosts[host]
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["latencies"].append(latency)
+            histogram = self.latency_histograms[host]
+            histogram["counts"][bucket] += 1
+            histogram["sum"] += latency
+            stats["status_codes"][response.status_code] += 1
+            if stack:
+                phase = self.phases[stack[-1]]
+                phase["requests"] += 1
+                phase["bytes"] += size
+
+    def record_chapters(self, module, state, count=1):
+        """Counts chapters of the module, state is found/downloaded/failed"""
+        with self.lock:
+            self.chapters[(module, state)] += count
+
+    def record_page(self, module, size):
+        """Counts a downloaded page of the module and its size"""
+        with self.lock:
+            self.pages[module] += 1
+            self.page_bytes[module] += size
+
+    def record_retry(self, host, status):
+        """Counts a retry made because of the status code"""
+        with self.lock:
+            self.retries[(host, status)] += 1
+
+    def record_report(self, state, count=1):
+        """Counts MangaDex@Home reports, state is sent/failed/dropped"""
+        with self.lock:
+            self.reports[state] += count
+
+    def record_hedge(self, link, won):
+        """Counts a hedged request to the host of the link"""
+        host = urlsplit(link).hostname
+        with self.lock:
+            self.hedges[(host, "started")] += 1
+            if won:
+                self.hedges[(host, "won")] += 1
+
+    def phase_totals(self):
+        """Returns the phase stats summed up over all of the manga"""
+        totals = defaultdict(
+            lambda: {"calls": 0, "time": 0.0, "requests": 0, "bytes": 0}
+        )
+        with self.lock:
+            for (_, name), phase in self.phases.items():
+                for key, value in phase.items():
+                    totals[name][key] += value
+        return dict(totals)
+
+    def to_dict(self):
+        """Returns all of the stats as a JSON serializable dict"""
+        per_manga = defaultdict(dict)
+        with self.lock:
+            for (manga, name), phase in self.phases.items():
+                per_manga[manga or "(no manga)"][name] = dict(phase)
+            manga_time = {
+                manga or "(no manga)": total for manga, total in self.manga_time.items()
+            }
+            module_stats = defaultdict(lambda: {"chapters": {}, "pages": 0, "bytes": 0})
+            for (module, state), count in self.chapters.items():
+                module_stats[module]["chapters"][state] = count
+            for module, count in self.pages.items():
+                module_stats[module]["pages"] = count
+                module_stats[module]["bytes"] = self.page_bytes[module]
+            reports = dict(self.reports)
+            retries = defaultdict(dict)
+            for (host, status), count in self.retries.items():
+                retries[host][str(status)] = count
+            hedges = defaultdict(dict)
+            for (host, state), count in self.hedges.items():
+                hedges[host][state] = count
+            hosts = {}
+            for host, stats in self.hosts.items():
+                host_stats = {k: v for k, v in stats.items() if k != "latencies"}
+                host_stats["status_codes"] = {
+                    str(k): v for k, v in stats["status_codes"].items()
+                }
+                host_stats["latency"] = latency_percentiles(stats["latencies"])
+                hosts[host] = host_stats
+        # Time spent sleeping comes from the rate limiters and retry policy
+        rate_limit_waits = utils.limiter_waits()
+        retry_waits = utils.RETRY_POLICY.waited
+        all_hosts = (
+            set(hosts)
+            | set(rate_limit_waits)
+            | set(retry_waits)
+            | set(retries)
+            | set(hedges)
+        )
+        for host in all_hosts:
+            host_stats = hosts.setdefault(
+                host,
+                {
+                    "requests": 0,
+                    "bytes": 0,
+                    "status_codes": {},
+                    "latency": latency_percentiles([]),
+                },
+            )
+            host_stats["rate_limit_wait"] = rate_limit_waits.get(host, 0.0)
+            host_stats["retry_wait"] = retry_waits.get(host, 0.0)
+            host_stats["adapter_retries"] = retries.get(host, {})
+            host_stats["hedged_requests"] = hedges.get(host, {})
+        return {
+            "phases": self.phase_totals(),
+            "hosts": hosts,
+            "manga": per_manga,
+            "manga_time": manga_time,
+            "modules": module_stats,
+            "reports": reports,
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def print_summary(self):
+        """Prints the phase and host stats"""
+        msg = "Timing statistics:"
+        print(f"\n{msg}\n{'-' * len(msg)}")
+        print("Phases:")
+        for name, phase in sorted(
+            self.phase_totals().items(), key=lambda p: p[1]["time"], reverse=True
+        ):
+            print(
+                f"    {name}: {phase['calls']} call(s) in {phase['time']:.2f} s, "
+                f"{phase['requests']} request(s)"
+            )
+
+        data = self.to_dict()
+        print("Hosts:")
+        for host, stats in sorted(data["hosts"].items(), key=lambda h: str(h[0])):
+            latency = stats["latency"]
+            print(
+                f"    {host}: {stats['requests']} request(s), "
+                f"{utils.format_size(stats['bytes'])}, latency "
+                f"p50 {latency['p50']:.2f} s / p90 {latency['p90']:.2f} s / "
+                f"p99 {latency['p99']:.2f} s"
+            )
+            if stats["rate_limit_wait"] or stats["retry_wait"]:
+                print(
+                    f"        waited {stats['rate_limit_wait']:.2f} s for the rate "
+                    f"limit and {stats['retry_wait']:.2f} s for retries"
+                )
+            hedges = stats["hedged_requests"]
+            if hedges:
+                print(
+                    f"        hedged {hedges.get('started', 0)} slow request(s), "
+                    f"the second one was faster {hedges.get('won', 0)} time(s)"
+                )
+
+        reports = data["reports"]
+        if reports:
+            print(
+                f"MangaDex@Home reports: {reports.get('sent', 0)} sent, "
+                f"{reports.get('failed', 0)} failed, "
+                f"{reports.get('dropped', 0)} dropped"
+            )
+
+        slowest = sorted(data["manga_time"].items(), key=lambda m: m[1], reverse=True)[
+            :5
+        ]
+        if slowest:
+            print("Slowest manga:")
+            for manga, total in slowest:
+                print(f"    {manga}: {total:.2f} s")
+
+
+def latency_percentiles(latencies):
+    """Returns the p50, p90 and p99 of the latencies"""
+    ordered = sorted(latencies)
+    result = {}
+    for q in (50, 90, 99):
+        if ordered:
+            index = min(len(ordered) - 1, int(len(ordered) * q / 100))
+            result[f"p{q}"] = ordered[index]
+        else:
+            result[f"p{q}"] = 0.0
+    return result
+
+
+# The stats of the current run
+STATS = Stats()
@@ -0,0 +1,673 @@
+"""Handles how the downloaded chapters and pages are saved."""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+# Keeps track of the downloaded pages of unfinished chapter directories
+MANIFEST_NAME = ".smd_manifest.json"
+# Archive pages bigger than this are kept in a temporary file instead of memory
+SPOOL_SIZE = 8 * 1024 * 1024
+# Archive pages that wait for an earlier page go to a temporary file once more
+# than this many are waiting
+MAX_HELD_IN_MEMORY = 16
+# Name of the content addressed page store in the download directory
+STORE_NAME = ".smd_store"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Name of the index of the downloaded chapters in the download directory
+INDEX_NAME = ".smd_index.sqlite"
+# Staging directories that weren't touched for this long are removed
+STAGING_MAX_AGE = 7 * 24 * 60 * 60
+
+# PageStore used for the downloaded pages, None if deduplication is off
+PAGE_STORE = None
+# LibraryIndex of the download directory
+LIBRARY_INDEX = None
+
+
+class PageFile:
+    """A page that is downloaded straight to a file
+
+    The data is written to a .part file that is renamed once complete, if the
+    download fails it's kept so the download can be continued
+    no_ext = save target Path object with no file extension
+    """
+
+    # Seconds the transfer of the page took, set by the downloader
+    transfer_time = None
+
+    def __init__(self, no_ext):
+        self.no_ext = no_ext
+        self.part = no_ext.with_name(f"{no_ext.name}.part")
+        self.hasher = None
+
+    @property
+    def offset(self):
+        """How many bytes are already downloaded"""
+        try:
+            return self.part.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def read_head(self, size):
+        """Returns the first bytes of the partial download"""
+        with open(self.part, "rb") as f:
+            return f.read(size)
+
+    def open(self, append=False):
+        """Opens the part file, hashes the data while writing if deduplicating"""
+        file = open(self.part, "ab" if append else "wb")
+        if PAGE_STORE is None:
+            return file
+        self.hasher = hashlib.sha256()
+        if append:
+            hash_file(self.part, self.hasher)
+        return HashingFile(file, self.hasher)
+
+    def discard(self):
+        if self.part.exists():
+            self.part.unlink()
+
+    def commit(self, file_type):
+        path = self.no_ext.with_name(f"{self.no_ext.name}.{file_type}")
+        self.part.replace(path)
+        if self.hasher is not None:
+            PAGE_STORE.add(path, self.hasher.hexdigest())
+
+
+class HashingFile:
+    """File wrapper that hashes all of the data written to it"""
+
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+class ArchivePage:
+    """A page that is downloaded into a chapter archive
+
+    The data is kept in memory (or a temporary file if it's big) until it's
+    complete and then written into the archive in one go
+    """
+
+    offset = 0
+    transfer_time = None
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+        self.file = None
+
+    def read_head(self, size):
+        return b""
+
+    @contextmanager
+    def open(self, append=False):
+        self.discard()
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        yield self.file
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def commit(self, file_type):
+        self.file.seek(0)
+        # The archive closes the file once it's written
+        self.archive.add(self.name, file_type, self.file)
+        self.file = None
+
+
+class DirectoryChapter:
+    """A chapter saved as a directory of images
+
+    The pages are downloaded into the hidden ".Chapter N.staging" directory
+    which is only renamed to "Chapter N" once every page is written to the
+    disk, so a "Chapter N" directory is always complete. Until then the
+    staging directory has a manifest with the finished pages, so a failed
+    chapter can be continued on the next run.
+    path = the chapter directory Path object
+    page_names = list of the page names in order
+    """
+
+    def __init__(self, path, page_names):
+        self.path = path
+        self.staging = staging_path(path)
+        self.page_count = len(page_names)
+        if not self.staging.exists() and (path / MANIFEST_NAME).exists():
+            # Unfinished chapter from before the staging directories
+            path.rename(self.staging)
+        self.staging.mkdir(exist_ok=True)
+        self.done = load_manifest(self.staging, self.page_count)
+        save_manifest(self.staging, self.page_count, self.done)
+
+    @property
+    def complete(self):
+        return len(self.done) == self.page_count
+
+    def page(self, page_name):
+        return PageFile(self.staging / page_name)
+
+    def page_done(self, n):
+        self.done.add(n)
+        save_manifest(self.staging, self.page_count, self.done)
+
+    def close(self):
+        if not self.complete:
+            save_manifest(self.staging, self.page_count, self.done)
+            return
+        (self.staging / MANIFEST_NAME).unlink()
+        with os.scandir(self.staging) as entries:
+            names = [entry.name for entry in entries]
+        for name in names:
+            fsync_path(self.staging / name)
+        fsync_path(self.staging)
+        if self.path.exists():
+            # Downloaded again over an existing directory
+            for name in names:
+                os.replace(self.staging / name, self.path / name)
+            self.staging.rmdir()
+        else:
+            self.staging.rename(self.path)
+        fsync_path(self.path.parent)
+
+
+class ArchiveChapter:
+    """A chapter saved as a .cbz archive (uncompressed zip)
+
+    The pages are written to "Chapter N.cbz.part" which is only renamed to
+    "Chapter N.cbz" once every page is in it. A unfinished archive is kept so
+    it can be continued on the next run.
+    Readers show the pages in the order of the archive, so a page that
+    finishes before the pages in front of it waits until they are written.
+    path = the final archive Path object
+    page_names = list of the page names in order
+    """
+
+    def __init__(self, path, page_names):
+        self.path = path
+        self.part = path.with_name(f"{path.name}.part")
+        self.page_count = len(page_names)
+        self.index = {name: n for n, name in enumerate(page_names)}
+        self.lock = threading.Lock()
+        self.zip = self.open_archive()
+        saved = {name.rsplit(".", 1)[0] for name in self.zip.namelist()}
+        self.done = {n for n, name in enumerate(page_names) if name in saved}
+        self.written = set(self.done)
+        # page number -> (entry name, file object) of the waiting pages
+        self.held = {}
+
+    def open_archive(self):
+        if self.part.exists():
+            try:
+                return zipfile.ZipFile(self.part, "a", zipfile.ZIP_STORED)
+            except zipfile.BadZipFile:
+                # Left behind by a crash, can't be continued
+                self.part.unlink()
+        return zipfile.ZipFile(self.part, "w", zipfile.ZIP_STORED)
+
+    @property
+    def complete(self):
+        return len(self.done) == self.page_count
+
+    def page(self, page_name):
+        return ArchivePage(self, page_name)
+
+    def add(self, name, file_type, fileobj):
+        """
+        Adds the page to the archive once the pages before it are in it
+        name = the page name without the extension
+        """
+        with self.lock:
+            self.held[self.index[name]] = (f"{name}.{file_type}", fileobj)
+            if len(self.held) > MAX_HELD_IN_MEMORY:
+                fileobj.rollover()
+            n = min(set(range(self.page_count)) - self.written)
+            while n in self.held:
+                self.write(n)
+                n += 1
+                while n in self.written:
+                    n += 1
+
+    def write(self, n):
+        entry_name, fileobj = self.held.pop(n)
+        with fileobj, self.zip.open(entry_name, "w") as entry:
+            shutil.copyfileobj(fileobj, entry)
+        self.written.add(n)
+
+    def page_done(self, n):
+        self.done.add(n)
+
+    def close(self):
+        # Written out of order so they don't need to be downloaded again, the
+        # archive is put in order once it's complete
+        for n in sorted(self.held):
+            self.write(n)
+        in_order = self.in_order()
+        self.zip.close()
+        if self.complete:
+            if not in_order:
+                self.reorder()
+            fsync_path(self.part)
+            self.part.replace(self.path)
+            fsync_path(self.path.parent)
+
+    def page_number(self, entry_name):
+        return self.index.get(entry_name.rsplit(".", 1)[0], self.page_count)
+
+    def in_order(self):
+        """If the entries of the archive are in the page order"""
+        numbers = [self.page_number(name) for name in self.zip.namelist()]
+        return numbers == sorted(numbers)
+
+    def reorder(self):
+        """Rewrites the archive with the entries in the page order"""
+        tmp = self.part.with_name(f"{self.part.name}.tmp")
+        with zipfile.ZipFile(self.part, "r") as old, zipfile.ZipFile(
+            tmp, "w", zipfile.ZIP_STORED
+        ) as new:
+            for info in sorted(
+                old.infolist(), key=lambda i: self.page_number(i.filename)
+            ):
+                with old.open(info) as src, new.open(info.filename, "w") as dst:
+                    shutil.copyfileobj(src, dst)
+        tmp.replace(self.part)
+
+
+class PageStore:
+    """Content addressed store of page files
+
+    Every stored file is hardlinked as "store/ab/abcdef...", files with the
+    same content are replaced with a hardlink to the stored one so the data
+    is only on the disk once. The store has to be on the same filesystem as
+    the pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, digest):
+        return self.path / digest[:2] / digest
+
+    def add(self, file, digest):
+        """
+        Adds the file to the store or replaces it with the stored copy
+        Returns the amount of bytes saved
+        """
+        blob = self.blob_path(digest)
+        try:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(file, blob)
+                return 0
+            except FileExistsError:
+                pass
+            if os.path.samefile(file, blob):
+                return 0
+            size = file.stat().st_size
+            link_file(blob, file)
+            return size
+        except OSError:
+            # Hardlinks not supported, the file just stays as it is
+            return 0
+
+    def clean_up(self):
+        """Removes the stored files that aren't used by any page any more"""
+        removed = 0
+        for blob in self.path.glob("*/*"):
+            if blob.stat().st_nlink == 1:
+                blob.unlink()
+                removed += 1
+        return removed
+
+
+class LibraryIndex:
+    """Index of the finished chapters and covers in the download directory
+
+    Lets the downloader know what is already downloaded without listing
+    every manga directory. Manga that aren't in the index yet are scanned
+    once and added. Only the downloader keeps it up to date, so changes
+    made by hand need a reindex.
+    directory = the download directory Path object
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(directory / INDEX_NAME), check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS manga (title TEXT PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS chapters ("
+            "title TEXT, name TEXT, format TEXT, pages INTEGER, size INTEGER, "
+            "PRIMARY KEY (title, name));"
+            "CREATE TABLE IF NOT EXISTS covers ("
+            "title TEXT, name TEXT, PRIMARY KEY (title, name));"
+        )
+        self.db.commit()
+
+    def chapters(self, title):
+        """Returns the set of finished chapter names of the manga"""
+        self.ensure_indexed(title)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM chapters WHERE title = ?", (title,)
+            ).fetchall()
+        return {name for (name,) in rows}
+
+    def covers(self, title):
+        """Returns the set of saved cover names (without extension)"""
+        self.ensure_indexed(title)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name FROM covers WHERE title = ?", (title,)
+            ).fetchall()
+        return {name for (name,) in rows}
+
+    def chapter_info(self, title):
+        """Returns {chapter name: (pages, size)} of the indexed chapters"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, pages, size FROM chapters WHERE title = ?", (title,)
+            ).fetchall()
+        return {name: (pages, size) for name, pages, size in rows}
+
+    def ensure_indexed(self, title):
+        with self.lock:
+            indexed = self.db.execute(
+                "SELECT 1 FROM manga WHERE title = ?", (title,)
+            ).fetchone()
+        if not indexed:
+            self.index_manga(title)
+
+    def index_manga(self, title):
+        """Replaces the entries of the manga with what is on the disk"""
+        chapters, covers = scan_manga(self.directory / title)
+        with self.lock:
+            self.db.execute("DELETE FROM chapters WHERE title = ?", (title,))
+            self.db.execute("DELETE FROM covers WHERE title = ?", (title,))
+            self.db.executemany(
+                "INSERT INTO chapters VALUES (?, ?, ?, ?, ?)",
+                [(title, *chapter) for chapter in chapters],
+            )
+            self.db.executemany(
+                "INSERT INTO covers VALUES (?, ?)", [(title, c) for c in covers]
+            )
+            self.db.execute("REPLACE INTO manga VALUES (?)", (title,))
+            self.db.commit()
+        return len(chapters)
+
+    def reindex(self):
+        """Rebuilds the whole index, returns the manga and chapter count"""
+        with self.lock:
+            self.db.execute("DELETE FROM manga")
+            self.db.execute("DELETE FROM chapters")
+            self.db.execute("DELETE FROM covers")
+            self.db.commit()
+        manga = 0
+        chapters = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith("."):
+                    manga += 1
+                    sweep_staging(Path(entry.path))
+                    chapters += self.index_manga(entry.name)
+        return (manga, chapters)
+
+    def add_chapter(self, title, path):
+        """Adds the finished chapter directory or archive"""
+        chapter = scan_chapter(path)
+        if chapter is None:
+            return
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO chapters VALUES (?, ?, ?, ?, ?)", (title, *chapter)
+            )
+            self.db.commit()
+
+    def add_cover(self, title, name):
+        with self.lock:
+            self.db.execute("REPLACE INTO covers VALUES (?, ?)", (title, name))
+            self.db.commit()
+
+    def forget_chapter(self, title, name):
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM chapters WHERE title = ? AND name = ?", (title, name)
+            )
+            self.db.commit()
+
+    def forget_manga(self, title):
+        """Removes the manga, it will be scanned again when needed"""
+        with self.lock:
+            for table in ("manga", "chapters", "covers"):
+                self.db.execute(f"DELETE FROM {table} WHERE title = ?", (title,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def scan_manga(manga_dir):
+    """
+    Lists the finished chapters and covers of the manga directory
+    Returns a list of (name, format, pages, size) chapter tuples and a list
+    of the cover names
+    """
+    chapters = []
+    covers = []
+    try:
+        entries = list(os.scandir(manga_dir))
+    except FileNotFoundError:
+        return (chapters, covers)
+    for entry in entries:
+        if entry.name.startswith(".") or entry.name.endswith(".part"):
+            continue
+        if entry.is_dir() or entry.name.endswith(".cbz"):
+            chapter = scan_chapter(Path(entry.path))
+            if chapter is not None:
+                chapters.append(chapter)
+        else:
+            covers.append(os.path.splitext(entry.name)[0])
+    return (chapters, covers)
+
+
+def scan_chapter(path):
+    """
+    Returns (name, format, pages, size) of a finished chapter directory or
+    archive, None if it's unfinished or broken
+    """
+    if path.suffix == ".cbz":
+        try:
+            with zipfile.ZipFile(path) as archive:
+                pages = len(archive.namelist())
+        except (OSError, zipfile.BadZipFile):
+            return None
+        return (path.stem, "cbz", pages, path.stat().st_size)
+
+    pages = 0
+    size = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == MANIFEST_NAME:
+                return None
+            if entry.name.startswith(".") or entry.name.endswith(".part"):
+                continue
+            pages += 1
+            size += entry.stat().st_size
+    return (path.name, "dir", pages, size)
+
+
+def staging_path(chapter_dir):
+    return chapter_dir.with_name(f".{chapter_dir.name}.staging")
+
+
+def fsync_path(path):
+    """Flushes the file or directory to the disk, if the OS allows it"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories can't be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def sweep_staging(manga_dir, max_age=STAGING_MAX_AGE):
+    """
+    Cleans up the staging directories of the manga
+    Removes the ones that have no pages at all, are for a chapter that
+    was finished in some other way or weren't touched for max_age seconds.
+    The rest are left to be continued. Returns how many were removed.
+    """
+    removed = 0
+    try:
+        entries = list(os.scandir(manga_dir))
+    except FileNotFoundError:
+        return removed
+    for entry in entries:
+        if not (entry.name.startswith(".") and entry.name.endswith(".staging")):
+            continue
+        staging = Path(entry.path)
+        chapter_name = entry.name[1 : -len(".staging")]
+        finished = (manga_dir / chapter_name).is_dir() and not (
+            manga_dir / chapter_name / MANIFEST_NAME
+        ).exists()
+        with os.scandir(staging) as files:
+            empty = all(f.name == MANIFEST_NAME for f in files)
+        stale = time.time() - entry.stat().st_mtime > max_age
+        if finished or empty or stale:
+            shutil.rmtree(staging, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def link_file(source, target):
+    """Replaces target with a hardlink to source"""
+    tmp = target.with_name(f"{target.name}.smd_link")
+    os.link(source, tmp)
+    tmp.replace(target)
+
+
+def hash_file(path, hasher=None):
+    """Hashes the file in chunks, returns the hasher"""
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def dedupe_library(directory, workers=None):
+    """
+    Deduplicates all of the files in the download directory
+    Only files with the same size are hashed, which is done in parallel.
+    Returns the amount of replaced files and bytes saved.
+    """
+    store = PageStore(directory / STORE_NAME)
+    by_size = defaultdict(dict)
+    for root, dirs, files in os.walk(directory):
+        # Skips the store and other hidden directories
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.startswith(".") or name.endswith(".part"):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            # Files that are already hardlinked only need to be checked once
+            by_size[stat.st_size].setdefault((stat.st_dev, stat.st_ino), path)
+
+    to_hash = [
+        path
+        for same_size in by_size.values()
+        if len(same_size) > 1
+        for path in same_size.values()
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(lambda p: hash_file(p).hexdigest(), to_hash)
+        by_hash = defaultdict(list)
+        for path, digest in zip(to_hash, digests):
+            by_hash[digest].append(path)
+
+    replaced = 0
+    saved = 0
+    for digest, paths in by_hash.items():
+        for path in paths:
+            size = store.add(Path(path), digest)
+            if size:
+                replaced += 1
+                saved += size
+    store.clean_up()
+    return (replaced, saved)
+
+
+def load_manifest(ch_dir, page_count):
+    """
+    Returns the set of finished page numbers from the chapter manifest
+    The manifest is ignored if the page count of the chapter changed
+    """
+    try:
+        with open(ch_dir / MANIFEST_NAME, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return set()
+    if manifest.get("pages") != page_count:
+        return set()
+    return set(manifest.get("done", []))
+
+
+def save_manifest(ch_dir, page_count, done):
+    """Saves the chapter manifest, replaces the old one in one step"""
+    path = ch_dir / MANIFEST_NAME
+    tmp = path.with_name(f"{MANIFEST_NAME}.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"pages": page_count, "done": sorted(done)}, f)
+    tmp.replace(path)
+
+
+def rename_archive_pages(path, old_title, new_title):
+    """
+    Renames the pages inside of a chapter archive, finished or .cbz.part
+    An unfinished archive that can't be read is deleted like ArchiveChapter
+    would do when continuing it
+    """
+    tmp = path.with_name(f"{path.name}.tmp")
+    try:
+        old = zipfile.ZipFile(path, "r")
+    except zipfile.BadZipFile:
+        if path.name.endswith(".part"):
+            path.unlink()
+            return
+        raise
+    with old, zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as new:
+        for info in old.infolist():
+            new_name = info.filename.replace(old_title, new_title, 1)
+            with old.open(info) as src, new.open(new_name, "w") as dst:
+                shutil.copyfileobj(src, dst)
+    tmp.replace(path)
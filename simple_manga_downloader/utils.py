@@ -1,10 +1,32 @@
+import io
+import queue
+import random
+import sys
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
 from functools import wraps
 from html import unescape
-
-import requests
+from urllib.parse import urlsplit
 
 REPLACEMENT_RULES = None
+RATE_LIMITS = None
+# How many of the latest response times of every host are kept
+LATENCY_SAMPLES = 200
+# Requests to a host are only hedged once it has this many response times
+MIN_LATENCY_SAMPLES = 20
+# Seconds over which the download throughput is checked
+STALL_WINDOW = 3
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+_latencies_lock = threading.Lock()
+_console_lock = threading.RLock()
+# PromptQueue of main_thread_prompts
+_prompts = None
 
 
 def clean_up_string(string):
@@ -22,32 +44,254 @@ def clean_up_string(string):
     return "".join(new_string_list)
 
 
-def limiter(seconds):
+class RateLimiter:
+    """Thread-safe token bucket rate limiter
+
+    rate = how many calls are allowed per second
+    burst = how many calls can be made at once after being idle
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_update = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeps until it's available
+
+        Tokens are reserved in call order so waiting callers are spaced out
+        evenly. Returns the amount of seconds slept.
+        """
+        with self.lock:
+            now = time.monotonic()
+            refill = (now - self.last_update) * self.rate
+            self.tokens = min(self.burst, self.tokens + refill) - 1
+            self.last_update = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def get_limiter(link, rate, burst=1):
+    """Returns the RateLimiter for the host of the link
+
+    The limiter is created with the given rate and burst on first use,
+    RATE_LIMITS from the config takes priority over them
+    """
+    host = urlsplit(link).hostname
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            if RATE_LIMITS and host in RATE_LIMITS:
+                rate, burst = RATE_LIMITS[host]
+            limiter = _limiters[host] = RateLimiter(rate, burst)
+    return limiter
+
+
+def limiter_waits():
+    """Returns how many seconds were spent waiting for each host limiter"""
+    with _limiters_lock:
+        return {host: limiter.waited for host, limiter in _limiters.items()}
+
+
+def record_latency(link, seconds):
+    """Saves how long the host of the link took to send the response headers"""
+    host = urlsplit(link).hostname
+    with _latencies_lock:
+        _latencies[host].append(seconds)
+
+
+def latency_p95(link):
+    """
+    Returns the p95 response time of the host of the link or None if there
+    aren't enough response times yet
+    """
+    host = urlsplit(link).hostname
+    with _latencies_lock:
+        latencies = sorted(_latencies.get(host, ()))
+    if len(latencies) < MIN_LATENCY_SAMPLES:
+        return None
+    return latencies[int(len(latencies) * 0.95)]
+
+
+class DownloadStalled(Exception):
+    """Raised when a download is slower than the minimum throughput
+
+    request = the stalled request, same as for the requests exceptions
+    """
+
+    def __init__(self, message, request=None):
+        super().__init__(message)
+        self.request = request
+
+
+class StallDetector:
+    """Checks that a download keeps up the minimum throughput
+
+    The throughput is checked every STALL_WINDOW seconds, the download is
+    only checked when it receives data so it should be read in small chunks
+    min_throughput = bytes per second
+    request = the request of the download
     """
-    Limits the decorated func to be called after given amount of seconds
+
+    def __init__(self, min_throughput, request=None):
+        self.min_throughput = min_throughput
+        self.request = request
+        self.window_start = time.monotonic()
+        self.window_size = 0
+
+    def update(self, size):
+        """Counts the received bytes, raises DownloadStalled if too slow"""
+        self.window_size += size
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < STALL_WINDOW:
+            return
+        throughput = self.window_size / elapsed
+        if throughput < self.min_throughput:
+            raise DownloadStalled(
+                f"Download stalled at {format_size(throughput)}/s, "
+                f"minimum is {format_size(self.min_throughput)}/s",
+                self.request,
+            )
+        self.window_start = now
+        self.window_size = 0
+
+
+class RetryPolicy:
+    """Decides if and when a failed request should be retried
+
+    attempts = max amount of attempts for a single request
+    backoff = base delay in seconds, doubles with every attempt
+    max_backoff = max delay in seconds
+    budget = how many retries can be made in total during a run, stops a dead
+    host from stalling everything
+    waited = seconds spent waiting before retries for each host
     """
 
-    def middle(func):
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, attempts=3, backoff=1, max_backoff=30, budget=100):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.waited = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def is_retryable(self, error):
+        """Checks if the exception is worth retrying"""
+        # requests is imported on first use, importing it slows down the start
+        import requests
+
+        if isinstance(error, DownloadStalled):
+            return True
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and (
+                error.response.status_code in self.retry_statuses
+            )
+        return isinstance(
+            error,
+            (
+                requests.Timeout,
+                requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+            ),
+        )
+
+    def take_retry(self):
+        """Uses up one retry from the budget, returns False if there is none left"""
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            if self.budget == 0:
+                print("Retry budget used up, failed requests won't be retried any more")
+            return True
+
+    def delay(self, attempt):
+        """Exponential backoff with full jitter for the given attempt number"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def wait(self, attempt, error):
+        """Sleeps before the next attempt of the request that caused the error"""
+        delay = self.delay(attempt)
+        host = None
+        if error.request is not None:
+            host = urlsplit(error.request.url).hostname
+        with self.lock:
+            self.waited[host] += delay
+        time.sleep(delay)
+
+
+# Replaced with one using the config settings on start
+RETRY_POLICY = RetryPolicy()
+
+
+def retry(func):
+    """
+    Decorator that retries the decorated request function using RETRY_POLICY
+    Raises the last exception if it can't be retried
+    """
 
-        last_called = 0
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        import requests
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            nonlocal last_called
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except (requests.RequestException, DownloadStalled) as e:
+                policy = RETRY_POLICY
+                if (
+                    attempt >= policy.attempts
+                    or not policy.is_retryable(e)
+                    or not policy.take_retry()
+                ):
+                    raise
+                policy.wait(attempt, e)
+            attempt += 1
 
-            before = time.time()
-            difference = before - last_called
-            if difference < seconds:
-                time.sleep(seconds - difference)
+    return wrapper
 
-            result = func(*args, **kwargs)
 
-            last_called = time.time()
-            return result
+def image_type(data):
+    """
+    Checks the magic bytes at the start of the data for the image type
+    Returns the file extension or None if the type is unknown
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    elif data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    elif data[4:12] == b"ftypavif":
+        return "avif"
+    elif data[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    elif data.startswith(b"BM"):
+        return "bmp"
+    return None
 
-        return wrapper
 
-    return middle
+def format_size(size):
+    """Returns the byte size as a human readable string"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
 
 
 def request_exception_handler(func):
@@ -58,6 +302,8 @@ def request_exception_handler(func):
 
     @wraps(func)
     def wrapper(*args, **kwargs):
+        import requests
+
         try:
             status = func(*args, **kwargs)
         except requests.Timeout:
@@ -71,6 +317,8 @@ def request_exception_handler(func):
             status = "Max retries reached"
         except requests.RequestException as e:
             status = f"A unexpected problem {e}"
+        except DownloadStalled as e:
+            status = str(e)
 
         return status
 
@@ -113,3 +361,153 @@ def ask_number(text, min_=None, max_=None, num_type=int):
         return False
 
     return number
+
+
+class ThreadedOutput:
+    """sys.stdout replacement that can buffer the output of single threads
+
+    Threads without a buffer write directly to the wrapped stream
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def buffered_output():
+    """Buffers everything the current thread prints
+
+    Once done the output is printed in one piece so it doesn't get mixed with
+    the output of other threads
+    """
+    with _console_lock:
+        if not isinstance(sys.stdout, ThreadedOutput):
+            sys.stdout = ThreadedOutput(sys.stdout)
+    output = sys.stdout
+    output.local.buffer = io.StringIO()
+    try:
+        yield
+    finally:
+        buffer = output.local.buffer
+        output.local.buffer = None
+        with _console_lock:
+            output.stream.write(buffer.getvalue())
+            output.stream.flush()
+
+
+class PromptQueue:
+    """The prompts of other threads waiting to be run on the main thread"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def ask(self, context, func, args, kwargs):
+        """Waits until the main thread ran func and returns its result"""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise KeyboardInterrupt
+            self.queue.put((future, context, func, args, kwargs))
+        return future.result()
+
+    def serve(self, futures):
+        """Runs the prompts until all of the futures are done"""
+        while not all(future.done() for future in futures):
+            try:
+                prompt = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.run(*prompt)
+
+    def run(self, future, context, func, args, kwargs):
+        try:
+            with _console_lock:
+                sys.stdout.write(context)
+                result = func(*args, **kwargs)
+                sys.stdout.flush()
+        except BaseException as e:
+            future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            future.set_result(result)
+
+    def close(self):
+        """Stops taking prompts and cancels the ones that are waiting"""
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                future = self.queue.get_nowait()[0]
+            except queue.Empty:
+                break
+            future.set_exception(KeyboardInterrupt())
+
+
+@contextmanager
+def main_thread_prompts():
+    """Runs the prompts of other threads on the main thread, see interactive
+
+    The main thread has to call serve() of the yielded PromptQueue, so
+    input() only runs on the main thread and Ctrl+C can't hang on a worker
+    """
+    global _prompts
+    prompts = PromptQueue()
+    _prompts = prompts
+    try:
+        yield prompts
+    finally:
+        prompts.close()
+    # After an interrupt the threads that are still running keep getting their
+    # prompts cancelled
+    _prompts = None
+
+
+def interactive(func, *args, **kwargs):
+    """Runs func with exclusive and unbuffered access to the console
+
+    Needed for anything that asks for user input while the output is buffered,
+    the already buffered output is printed first so the question has context.
+    Inside of main_thread_prompts the prompts of other threads are run on the
+    main thread one at a time.
+    Returns what func returns
+    """
+    output = sys.stdout
+    buffer = None
+    if isinstance(output, ThreadedOutput):
+        buffer = getattr(output.local, "buffer", None)
+    context = buffer.getvalue() if buffer is not None else ""
+
+    prompts = _prompts
+    on_main = threading.current_thread() is threading.main_thread()
+    if prompts is not None and not on_main:
+        if buffer is not None:
+            output.local.buffer = io.StringIO()
+        return prompts.ask(context, func, args, kwargs)
+
+    with _console_lock:
+        if buffer is None:
+            return func(*args, **kwargs)
+        output.stream.write(context)
+        output.local.buffer = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            output.stream.flush()
+            output.local.buffer = io.StringIO()
@@ -0,0 +1,178 @@
+"""Checks the downloaded chapters for truncated or corrupt images."""
+import os
+import shutil
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from . import storage
+from .utils import image_type
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Broken chapters are moved here (inside of the download directory)
+QUARANTINE_NAME = ".smd_quarantine"
+# How much of the end of the image is searched for the end marker
+TAIL_SIZE = 1024
+
+
+def check_image(head, tail, size):
+    """
+    Checks the start and end of the image data
+    Returns the problem or None if it looks fine
+    """
+    file_type = image_type(head)
+    if file_type is None:
+        return "unknown image type"
+    tail = tail.rstrip(b"\x00")
+    if file_type == "jpeg" and b"\xff\xd9" not in tail:
+        return "truncated JPEG"
+    if file_type == "png" and b"IEND" not in tail:
+        return "truncated PNG"
+    if file_type == "gif" and not tail.endswith(b";"):
+        return "truncated GIF"
+    if file_type == "webp" and struct.unpack("<I", head[4:8])[0] + 8 > size:
+        return "truncated WebP"
+    if file_type == "bmp" and struct.unpack("<I", head[2:6])[0] > size:
+        return "truncated BMP"
+    return None
+
+
+def decode_image(file):
+    """Decodes the whole image with Pillow, returns the problem or None"""
+    try:
+        with Image.open(file) as image:
+            image.load()
+    except Exception as e:
+        return f"can't be decoded ({e})"
+    return None
+
+
+def check_file(path, decode):
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(16)
+        f.seek(max(0, size - TAIL_SIZE))
+        tail = f.read()
+    problem = check_image(head, tail, size)
+    if problem is None and decode:
+        problem = decode_image(path)
+    return problem
+
+
+def check_archive(path, decode):
+    """Returns the problems and page count of the chapter archive"""
+    problems = []
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+            if bad is not None:
+                problems.append(f"{bad}: checksum mismatch")
+            for info in archive.infolist():
+                with archive.open(info) as f:
+                    data = f.read()
+                problem = check_image(data[:16], data[-TAIL_SIZE:], len(data))
+                if problem is None and decode:
+                    with archive.open(info) as f:
+                        problem = decode_image(f)
+                if problem is not None:
+                    problems.append(f"{info.filename}: {problem}")
+            pages = len(archive.namelist())
+    except (OSError, zipfile.BadZipFile) as e:
+        return ([f"broken archive ({e})"], 0)
+    return (problems, pages)
+
+
+def check_chapter(path, recorded, decode):
+    """
+    Checks every page of the chapter directory or archive
+    recorded = (pages, size) from the library index or None
+    Returns the path and the list of problems
+    """
+    if path.endswith(".cbz"):
+        problems, pages = check_archive(path, decode)
+        size = os.path.getsize(path)
+    else:
+        problems = []
+        pages = 0
+        size = 0
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.startswith(".") or entry.name.endswith(".part"):
+                    continue
+                pages += 1
+                size += entry.stat().st_size
+                problem = check_file(entry.path, decode)
+                if problem is not None:
+                    problems.append(f"{entry.name}: {problem}")
+    if recorded is not None:
+        recorded_pages, recorded_size = recorded
+        if pages != recorded_pages:
+            problems.append(f"has {pages} page(s) instead of {recorded_pages}")
+        elif size != recorded_size:
+            problems.append(f"size is {size} bytes instead of {recorded_size}")
+    return (path, problems)
+
+
+def find_chapters(directory, index):
+    """Yields the (path, recorded) of every finished chapter in the library"""
+    with os.scandir(directory) as manga_entries:
+        manga_dirs = sorted(
+            e.path for e in manga_entries if e.is_dir() and not e.name.startswith(".")
+        )
+    for manga_dir in manga_dirs:
+        title = os.path.basename(manga_dir)
+        recorded = index.chapter_info(title)
+        with os.scandir(manga_dir) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    name = entry.name
+                elif entry.name.endswith(".cbz"):
+                    name = entry.name[: -len(".cbz")]
+                else:
+                    continue
+                yield (entry.path, recorded.get(name))
+
+
+def verify_library(directory, workers=None, decode=False):
+    """
+    Checks all of the chapters of the library in parallel processes
+    Yields the (path, problems) of every chapter
+    """
+    index = storage.LibraryIndex(directory)
+    chapters = list(find_chapters(directory, index))
+    index.close()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            check_chapter,
+            [path for path, _ in chapters],
+            [recorded for _, recorded in chapters],
+            [decode] * len(chapters),
+            chunksize=16,
+        )
+        yield from results
+
+
+def quarantine(index, chapter_path):
+    """
+    Moves the broken chapter out of the library and drops it from the index
+    so it is downloaded again on the next run
+    index = LibraryIndex of the library
+    """
+    manga_dir, chapter = os.path.split(chapter_path)
+    title = os.path.basename(manga_dir)
+    target = index.directory / QUARANTINE_NAME / title / chapter
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.is_dir():
+        # Quarantined before
+        shutil.rmtree(target)
+    os.replace(chapter_path, target)
+    if chapter.endswith(".cbz"):
+        chapter = chapter[: -len(".cbz")]
+    index.forget_chapter(title, chapter)
+    return target
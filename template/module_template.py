@@ -1,6 +1,8 @@
-import re
-
-import requests
+# The module needs a ModuleInfo entry in MODULES of modules/__init__.py, or in a
+# separate package an entry point in the simple_manga_downloader.modules group
+# pointing at a ModuleInfo (see USAGE.md). Imports relative to the package
+# (..utils, .manga) have to be absolute then. The site_re of the class is set
+# from the ModuleInfo.
 from bs4 import BeautifulSoup
 
 from ..utils import clean_up_string, request_exception_handler
@@ -9,8 +11,11 @@ from .manga import BaseManga
 
 class MangaPageName(BaseManga):
     base_link = "https://site.com"
-    session = requests.Session()
-    site_re = re.compile(r"regex for site")
+
+    @classmethod
+    def setup_session(cls, session):
+        """Optional, the session is created on first use"""
+        session.headers.update({"Referer": cls.base_link})
 
     def __init__(self, link, title=None):
         if title: